@@ -1,4 +1,6 @@
 
+import asyncio
+import queue
 import time
 from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
@@ -6,9 +8,10 @@ from dataclasses import dataclass, field
 import streamlit as st
 from streamlit_markmap import markmap
 
-from search.bing import BingSearch
+from search.bing import get_bing_search
 from search.arxiv import ArxivSearch
-from llm import get_rag_query, get_related_questions, summarize_query_to_name, is_answer_denying_query
+import async_llm
+from llm import get_rag_query, get_rag_query_with_metadata, get_related_questions
 
 st.set_page_config(page_title="Taifu-太傅", layout="wide")
 
@@ -41,10 +44,10 @@ if "query_on_start" not in st.session_state:
     st.session_state.query_on_start = ""
 if "thread_pool_executor" not in st.session_state:
     st.session_state.thread_pool_executor = ThreadPoolExecutor(4)
-if "mindmap_generator" not in st.session_state:
-    st.session_state.mindmap_generator = None
+if "mindmap_expansion" not in st.session_state:
+    st.session_state.mindmap_expansion = None
 
-bing_search = BingSearch(st.secrets["BING_SEARCH_SUB_KEY"])
+bing_search = get_bing_search(st.secrets["BING_SEARCH_SUB_KEY"])
 
 
 def buildMarkmapData(node: Node, depth: int = 0) -> str:
@@ -61,13 +64,12 @@ def buildMarkmapData(node: Node, depth: int = 0) -> str:
 def do_query(query):
     st.session_state.query_prompt = query
     current_node.query = query
-    current_node.name = summarize_query_to_name(query)
     query_result = bing_search.search(query)
     current_node.search_result = query_result
-    contexts = query_result["value"]
-    current_node.answer = get_rag_query(query, contexts)
-    more_related_questions = get_related_questions(query, contexts)
-    current_node.related_questions = more_related_questions
+    result = get_rag_query_with_metadata(query, query_result["value"])
+    current_node.name = result["name"]
+    current_node.answer = result["answer"]
+    current_node.related_questions = result["related_questions"]
     st.rerun()
 
 def rag_query_to_node(query, contexts, node: Node) -> None:
@@ -76,33 +78,93 @@ def rag_query_to_node(query, contexts, node: Node) -> None:
 def related_questions_to_node(query, contexts, node: Node) -> None:
     node.related_questions = get_related_questions(query, contexts)
 
-def query_and_auto_mindmap(query: str, current_node: Node, depth: int = 0, max_depth: int = 1):
-    print(f"start query: {query}")
-    current_node.query = query
-    current_node.name = summarize_query_to_name(query)
-    print(f"summarized title as {current_node.name}")
-    query_result = bing_search.search(query)
-    current_node.search_result = query_result
-    print(f"searched result: {len(query_result['value'])}")
-    contexts = query_result["value"]
-    rag_query_to_node(query, contexts, current_node)
-    print(f"summarized query result")
-    if is_answer_denying_query(query, current_node.answer):
-        yield current_node
-        return None
-    related_questions = get_related_questions(query, current_node.answer)
-    print(f"got related questions: {related_questions}")
-    current_node.related_questions = related_questions
-    yield current_node
-    if depth >= max_depth:
-        return None
-    for q in related_questions:
-        node = Node(prev=current_node)
-        current_node.children.append(node)
-        for node in query_and_auto_mindmap(q['question'], node, depth+1, max_depth):
-            if node:
-                yield node
-            continue
+class MindmapExpansion(object):
+    """
+    Expands a query into a mindmap on the async_llm loop. Nodes are
+    expanded breadth-first, at most `concurrency` at a time, and handed to
+    the script through a queue as each one finishes.
+    """
+
+    def __init__(self, query: str, root: Node, max_depth: int = 1, concurrency: int = 4) -> None:
+        self.max_depth = max_depth
+        self._finished: queue.SimpleQueue[Node] = queue.SimpleQueue()
+        self._concurrency = concurrency
+        self._root = root
+        self._future = async_llm.submit(self._run(query, root))
+
+    @property
+    def done(self) -> bool:
+        return self._future.done() and self._finished.empty()
+
+    def cancel(self) -> None:
+        self._future.cancel()
+
+    def drain(self, timeout: float = None) -> list[Node]:
+        """
+        Returns the nodes finished since the last call, waiting up to timeout
+        for the first one. Children are attached to the tree here, on the
+        script thread.
+        """
+        nodes = []
+        try:
+            nodes.append(self._finished.get(timeout=timeout))
+            while True:
+                nodes.append(self._finished.get_nowait())
+        except queue.Empty:
+            pass
+        for node in nodes:
+            if node is not self._root:
+                node.prev.children.append(node)
+        return nodes
+
+    async def _run(self, query: str, root: Node) -> None:
+        # created here, semaphores belong to the loop they are used on
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        await self._expand_tree(query, root, 0)
+
+    async def _expand_tree(self, query: str, node: Node, depth: int) -> None:
+        try:
+            async with self._semaphore:
+                related_questions = await self._expand(query, node)
+        except Exception as e:
+            print(f"failed to expand {query}: {e}")
+            return
+        self._finished.put(node)
+        if depth >= self.max_depth:
+            return
+        # all children queue on the semaphore before any grandchild exists,
+        # which keeps the expansion breadth-first
+        await asyncio.gather(*(
+            self._expand_tree(q['question'], Node(prev=node), depth + 1)
+            for q in related_questions))
+
+    async def _expand(self, query: str, node: Node) -> list:
+        print(f"start query: {query}")
+        query_result = await bing_search.asearch(query)
+        print(f"searched result: {len(query_result['value'])}")
+        # set before the answer, the page shows it once search_result is set
+        node.query = query
+        node.search_result = query_result
+        on_answer = None
+        if node is self._root:
+            # the root is on screen already, let its answer stream in
+            def on_answer(answer):
+                node.answer = answer
+        # answer, name, premise check and follow-ups in a single response
+        result = await async_llm.get_rag_query_with_metadata(
+            query, query_result["value"], on_answer)
+        print(f"summarized {result['name']}")
+        related_questions = [] if result["denies_premise"] else result["related_questions"]
+        print(f"got related questions: {related_questions}")
+        node.name = result["name"]
+        node.answer = result["answer"]
+        node.related_questions = related_questions
+        return related_questions
+
+
+def query_and_auto_mindmap(query: str, current_node: Node, max_depth: int = 1) -> MindmapExpansion:
+    concurrency = int(st.secrets.get("AUTO_MINDMAP_CONCURRENCY", 4))
+    return MindmapExpansion(query, current_node, max_depth, concurrency)
 
 
 col_left, col_right = st.columns([1, 1])
@@ -135,8 +197,9 @@ with col_right.container():
                 st.rerun()
     
     if query := st.chat_input(st.session_state.query_prompt):
-        mindmap_generator = query_and_auto_mindmap(query, current_node, depth=0, max_depth=2)
-        st.session_state.mindmap_generator = mindmap_generator
+        if st.session_state.mindmap_expansion:
+            st.session_state.mindmap_expansion.cancel()
+        st.session_state.mindmap_expansion = query_and_auto_mindmap(query, current_node, max_depth=2)
         st.rerun()
         # for node in query_and_auto_mindmap(query, current_node, depth=0, max_depth=2):
         #     st.session_state.current_node = node
@@ -153,8 +216,8 @@ with col_right.container():
         st.write("相关问题：")
         for q in current_node.related_questions:
             def add_node(query):
-                node = Node(prev=current_node,
-                            name=summarize_query_to_name(query), query=query)
+                # do_query names it from the same response as the answer
+                node = Node(prev=current_node, name=query, query=query)
                 current_node.children.append(node)
                 st.session_state.query_on_start = query
                 st.session_state.current_node = node
@@ -164,14 +227,10 @@ with col_right.container():
         st.session_state.query_on_start = ""
         do_query(query_on_start)
     
-    if mindmap_generator:= st.session_state.mindmap_generator:
-        try:
-            node = mindmap_generator.__next__()
-            if node:
-                st.session_state.current_node = node
-                st.rerun()
-        except StopIteration as e:
-            st.session_state.mindmap_generator = None
-        except ValueError as e:
-            pass
+    if mindmap_expansion := st.session_state.mindmap_expansion:
+        if nodes := mindmap_expansion.drain(timeout=0.5):
+            st.session_state.current_node = nodes[-1]
+        if mindmap_expansion.done:
+            st.session_state.mindmap_expansion = None
+        st.rerun()
 
@@ -1,6 +1,6 @@
 
 import json
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import date
 from uuid import uuid4
 
@@ -8,14 +8,18 @@ import streamlit as st
 from loguru import logger
 from streamlit_markmap import markmap
 
-from llm import (chat_on_paper_with_moonshot, get_rag_query,
-                 get_related_concepts, get_related_questions,
+from budget import KEEP_RECENT_MESSAGES, needs_compaction
+from llm import (chat_on_paper_with_moonshot, compact_chat_history,
+                 get_enrichment, get_rag_query,
                  is_answer_denying_query, summarize_chat,
                  summarize_paper_with_moonshot, summarize_query_to_name)
-from search.arxiv import ArxivSearch
-from search.gscholar import GoogleScholarSearch
+from search.citations import citation_cache
+from search.download import pdf_path
+from search.federated import FederatedSearch
+from search.gscholar import MAX_RECORDS
+from search.pdf import extract_document, paper_store
 from slides import SlidesGenerator
-from structs import ChatMessage, Node
+from structs import Article, ChatMessage, Node, PaperDocument
 
 st.set_page_config(page_title="Taifu-太傅", layout="wide")
 
@@ -32,6 +36,8 @@ if "query_on_start" not in st.session_state:
     st.session_state.query_on_start = ""
 if "thread_pool_executor" not in st.session_state:
     st.session_state.thread_pool_executor = ThreadPoolExecutor(4)
+if "pending_enrichments" not in st.session_state:
+    st.session_state.pending_enrichments = []
 if "mindmap_generator" not in st.session_state:
     st.session_state.mindmap_generator = None
 if "global_search_result" not in st.session_state:
@@ -39,8 +45,10 @@ if "global_search_result" not in st.session_state:
 if "ppt_download_path" not in st.session_state:
     st.session_state.ppt_download_path = ""
 if "search" not in st.session_state:
-    search = GoogleScholarSearch()
+    search = FederatedSearch()
     st.session_state.search = search
+if "pending_search" not in st.session_state:
+    st.session_state.pending_search = None
 if "node_tree_download_path" not in st.session_state:
     st.session_state.node_tree_download_path = ""
 
@@ -57,24 +65,24 @@ def buildMarkmapData(node: Node, depth: int = 0) -> str:
     return md_content
 
 
-def do_query(query):
+def do_query(query, backends: list[str] = None):
     current_node = st.session_state.current_node
     if current_node is st.session_state.root_node:
         current_node.query = query
         current_node.name = query
     search = st.session_state.search
-    query_result = search.search(query)
+    st.session_state.pending_search = search.submit(query, backends=backends)
     st.session_state.query_prompt = f"主题> {query}"
-    st.session_state.global_search_result = query_result
+    st.session_state.global_search_result = []
 
 def do_more_query(length:int = 10):
-    if st.session_state.global_search_result is None:
+    if st.session_state.global_search_result is None or st.session_state.pending_search:
         return
     search = st.session_state.search
     query_result = search.more(length)
     st.session_state.global_search_result += query_result
 
-def do_advanced_query(query: str, year_from: str, sort_by: str):
+def do_advanced_query(query: str, year_from: str, sort_by: str, backends: list[str] = None):
     current_node = st.session_state.current_node
     if current_node is st.session_state.root_node:
         current_node.query = query
@@ -84,9 +92,21 @@ def do_advanced_query(query: str, year_from: str, sort_by: str):
     else:
         year_from = int(year_from.split(" ")[-1])
     search = st.session_state.search
-    query_result = search.search(query, year_from, sort_by.lower())
+    st.session_state.pending_search = search.submit(
+        query, year_from, sort_by.lower(), backends)
     st.session_state.query_prompt = f"主题> {query}"
-    st.session_state.global_search_result = query_result
+    st.session_state.global_search_result = []
+
+
+def poll_pending_search(timeout: float = 0.5):
+    """
+    Appends the results of the backends that answered meanwhile, so partial
+    results render while slower backends are still searching.
+    """
+    pending_search = st.session_state.pending_search
+    st.session_state.global_search_result += pending_search.poll(timeout)
+    if pending_search.done:
+        st.session_state.pending_search = None
 
 
 def rag_query_to_node(query, contexts, node: Node) -> None:
@@ -96,41 +116,121 @@ def rag_query_to_node(query, contexts, node: Node) -> None:
 #     node.related_questions = get_related_questions(query, contexts)
 
 
-def start_chat_with_paper(current_node: Node, article):
+def start_chat_with_paper(current_node: Node, article: Article):
     if current_node.node_type == "paper":
         parent_node = current_node.prev
     elif current_node.node_type == "concept":
         parent_node = current_node
-    if node := parent_node.get_child_by_name(article['title']):
+    if node := parent_node.get_child_by_name(article.title):
         st.session_state.current_node = node
     else:
         search = st.session_state.search
-        node = Node(name=article['title'])
+        node = Node(name=article.title)
         node.article = article
         node.node_type = "paper"
-        node.prev = parent_node
-        parent_node.children.append(node)
+        parent_node.add_child(node)
         st.session_state.current_node = node
-        if "arxiv.org" not in article['url']:
+        if "arxiv.org" not in article.url:
             node.need_upload_paper = True
         else:
-            node.paper_content = search.download_and_read(article)
+            node.paper_id = search.download_and_parse(article).id
             node.current_stream = summarize_paper_with_moonshot(
-                f"arxiv_pdf/{article['id'] + '.pdf'}", st.secrets.get('DELETE_PAPER', False))
+                pdf_path(article), st.secrets.get('DELETE_PAPER', False))
+
+
+def get_paper(node: Node) -> PaperDocument | str | None:
+    """
+    Returns the paper of a node. A paper missing from the local store, e.g.
+    of a tree exported by another deployment, is parsed again from its
+    article. Returns None and asks for an upload when that is not possible.
+    """
+    if node.paper_id and (doc := paper_store.get(node.paper_id)):
+        return doc
+    if node.paper_content:
+        return node.paper_content
+    if node.article and "arxiv.org" in node.article.url:
+        try:
+            doc = st.session_state.search.download_and_parse(node.article)
+            node.paper_id = doc.id
+            return doc
+        except Exception as e:
+            logger.error(f"failed to rebuild paper {node.article.url}: {e}")
+    node.need_upload_paper = True
+    return None
+
+
+def chat_on_paper(current_node: Node, question: str):
+    if (paper := get_paper(current_node)) is None:
+        # the upload form is shown instead, never chat on an empty paper
+        return
+    current_node.messages.append(ChatMessage("user", question))
+    current_node.current_stream = chat_on_paper_with_moonshot(
+        paper, current_node.recent_messages,
+        history_summary=current_node.history_summary)
 
 
-def get_paper_related_questions(current_node: Node, summary: str):
-    logger.info("getting related questions...")
-    current_node.related_questions = get_related_questions(
-        current_node.name, summary)
-    logger.info("getting related questions...done")
+def get_paper_enrichment(current_node: Node, summary: str):
+    logger.info("getting related questions and concepts...")
+    enrichment = get_enrichment(current_node.name, summary)
+    # keep what an earlier enrichment already filled
+    current_node.related_questions = current_node.related_questions or enrichment["questions"]
+    current_node.related_concepts = current_node.related_concepts or enrichment["concepts"]
+    logger.info("getting related questions and concepts...done")
 
 
-def get_paper_related_concepts(current_node: Node, summary: str):
-    logger.info("getting related concepts...")
-    current_node.related_concepts = get_related_concepts(
-        current_node.name, summary)
-    logger.info("getting related concepts...done")
+def compact_paper_history(current_node: Node, summary: str):
+    pending = current_node.recent_messages
+    if not needs_compaction([{"content": m.message} for m in pending]):
+        return
+    fold = pending[:-KEEP_RECENT_MESSAGES]
+    logger.info(f"compacting {len(fold)} chat messages...")
+    current_node.history_summary = compact_chat_history(
+        current_node.history_summary, fold)
+    current_node.summarized_count += len(fold)
+    logger.info("compacting chat messages...done")
+
+
+def schedule_paper_enrichments(current_node: Node, summary: str):
+    """
+    Runs the post-stream enrichments of a node on the session thread pool.
+    The futures are polled at the end of every rerun so each result is
+    rendered as soon as it lands.
+    """
+    enrichments = []
+    if not current_node.related_questions or not current_node.related_concepts:
+        # one request answers both
+        enrichments.append(get_paper_enrichment)
+    if current_node.node_type == "paper":
+        enrichments.append(compact_paper_history)
+    executor = st.session_state.thread_pool_executor
+    st.session_state.pending_enrichments += [
+        executor.submit(enrichment, current_node, summary) for enrichment in enrichments]
+
+
+def poll_pending_enrichments(timeout: float = 0.5):
+    pending = st.session_state.pending_enrichments
+    done, not_done = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+    for future in done:
+        if e := future.exception():
+            logger.error(f"encountered error while enriching paper: {e}")
+    st.session_state.pending_enrichments = list(not_done)
+
+
+def author_markdown(article: Article) -> str:
+    """
+    Links authors to their Scholar profile, with affiliation and citations
+    on hover once the profile is cached.
+    """
+    names = []
+    for author in article.authors:
+        if not author.id:
+            names.append(author.name)
+        elif profile := citation_cache.author(author.id):
+            hint = f"{profile['affiliation']}, cited by {profile['citedby']}".replace('"', "'")
+            names.append(f'[{author.name}]({author.citation_url} "{hint}")')
+        else:
+            names.append(f"[{author.name}]({author.citation_url})")
+    return ", ".join(names)
 
 
 def display_search_result(node: Node):
@@ -141,19 +241,19 @@ def display_search_result(node: Node):
             with st.container(border=True):
                 col_title, col_link, col_chat_btn = st.columns([6, 1, 2])
                 with col_title.container():
-                    st.write(f"**{article['title']}**")
-                    # st.page_link(article['url'], label=article['title'], icon="🔗", use_container_width=True, help=article['title'])
+                    st.write(f"**{article.title}**")
+                    # st.page_link(article.url, label=article.title, icon="🔗", use_container_width=True, help=article.title)
                 with col_link.container():
-                    st.page_link(article['url'], label="🔗"
+                    st.page_link(article.url, label="🔗"
                                 , use_container_width=True)
                 with col_chat_btn.container():
                     st.button("Chat", use_container_width=True,
-                            key=article['id'], on_click=start_chat_with_paper, args=(current_node, article))
+                            key=article.id, on_click=start_chat_with_paper, args=(current_node, article))
                 with st.container(height=155, border=False):
-                    author_md = ", ".join([f"[{author['name']}]({author['citation_url']})" if author['id'] else author['name'] for author in article['authors']])
-                    st.write(f"{author_md} - {article['journal_ref']}, {article['publish_date']}, Cited by {article['num_citations']}")
-                    st.caption(f"**Abstract:** {article['abstract']}")
-        if len(st.session_state.global_search_result) < 30: # to prevent blocked by google
+                    author_md = author_markdown(article)
+                    st.write(f"{author_md} - {article.journal_ref}, {article.publish_date}, Cited by {article.num_citations}")
+                    st.caption(f"**Abstract:** {article.abstract}")
+        if len(st.session_state.global_search_result) < MAX_RECORDS: # to prevent blocked by google
             _, col_next, _ = st.columns([1,1,1])
             with col_next.container():
                 st.button("More", on_click=do_more_query, args=(10,), use_container_width=True)
@@ -166,29 +266,27 @@ def on_related_concept(current_node: Node, concept: str):
     if node := current_node.get_child_by_name(concept):
         st.session_state.current_node = node
     else:
-        node = Node(name=concept, node_type="concept")
-        node.prev = current_node
-        current_node.children.append(node)
+        node = current_node.add_child(Node(name=concept, node_type="concept"))
         st.session_state.query_on_start = concept
         st.session_state.current_node = node
 
 
 def on_related_question(current_node: Node, question: str):
-    current_node.messages.append(ChatMessage("user", question))
-    current_node.current_stream = chat_on_paper_with_moonshot(
-        current_node.paper_content, current_node.messages)
+    chat_on_paper(current_node, question)
 
 
-def switch_to_node(node: Node):
-    if not st.session_state.current_node is node:
+def switch_to_node(node_id: str):
+    if node := st.session_state.root_node.store.get(node_id):
         st.session_state.current_node = node
 
 
-def remove_node(node: Node):
-    prev = node.prev
-    if not prev:
+def remove_node(node_id: str):
+    # by id, sibling papers may share a title
+    node = st.session_state.root_node.store.get(node_id)
+    if not node or not node.prev:
         return
-    prev.remove_child_by_name(node.name)
+    prev = node.prev
+    prev.remove_child(node_id)
     st.session_state.current_node = prev
 
 def gen_ppt():
@@ -233,10 +331,10 @@ with st.sidebar:
                   type="primary", disabled=True)
         if current_node.prev:
             st.button("REMOVE NODE", use_container_width=True,
-                      type="primary", on_click=remove_node, args=(current_node, ))
+                      type="primary", on_click=remove_node, args=(current_node.id, ))
     st.write("Child nodes")
     for child in current_node.children:
-        st.button(child.display_name, on_click=switch_to_node, args=(child, ))
+        st.button(child.display_name, on_click=switch_to_node, args=(child.id, ), key=f"child_{child.id}")
 
     st.divider()
     st.text("导出/入脑图")
@@ -259,39 +357,37 @@ with col_left.container():
     with st.container(border=True, height=250):
         markmap(data, height=200)
     use_arxiv_only = st.checkbox("Only search from arxiv.org")
+    backends = ["arxiv"] if use_arxiv_only else None
     col_search_bar, col_advanced = st.columns([4,1])
     with col_search_bar.container():
         if query := st.chat_input(st.session_state.query_prompt):
-            if use_arxiv_only:
-                query += " site:arxiv.org"
-            do_query(query)
+            do_query(query, backends)
             st.rerun()
     with col_advanced.container():
         popover = st.popover("高级", help="高级搜索")
         query = popover.text_input("Topic AND/OR Author")
-        if use_arxiv_only:
-            query += " site:arxiv.org"
         unlimited = "Unlimited"
         this_year = f"Since {date.today().year}"
         last_year = f"Since {date.today().year - 1}"
         four_years_ago = f"Since {date.today().year - 4}"
         date_range = popover.selectbox("Published Year", [unlimited, this_year, last_year, four_years_ago])
         sort_by = popover.selectbox("Sort by", ["Relevance", "Date"])
-        popover.button("Search", type="primary", on_click=do_advanced_query, args=(query, date_range, sort_by))
+        popover.button("Search", type="primary", on_click=do_advanced_query, args=(query, date_range, sort_by, backends))
     # render current node
     display_search_result(current_node)
 with col_right.container():
     current_node = st.session_state.current_node
     if current_node.article:
-        st.markdown(f"### {current_node.article['title']}")
+        st.markdown(f"### {current_node.article.title}")
         if current_node.need_upload_paper:
             st.write("We currently don't support reading paper from this website.")
             if paper := st.file_uploader("But you can upload by yourself. Choose a PDF file:", type="pdf"):
                 bytes_data = paper.read()
-                filepath = current_node.article['title'].lower().replace(" ", "_") + ".pdf"
+                filepath = current_node.article.title.lower().replace(" ", "_") + ".pdf"
                 with open(filepath, "wb") as f:
                     f.write(bytes_data)
                 current_node.need_upload_paper = False
+                current_node.paper_id = extract_document(filepath).id
                 current_node.current_stream = summarize_paper_with_moonshot(filepath, True)
                 st.rerun()
             st.divider()
@@ -300,31 +396,33 @@ with col_right.container():
                 st.write("Haven't obtained this paper?")
             with col_drop_paper.container():
                 popover = st.popover("Drop it", use_container_width=True)
-                popover.button("Confirm", on_click=remove_node, args=(current_node,), type="primary", use_container_width=True)
+                popover.button("Confirm", on_click=remove_node, args=(current_node.id,), type="primary", use_container_width=True)
     # with col_cite.container():
     #     st.button("Cite me", type="primary", use_container_width=True)
     # Chat part
     else:
         search_result = st.session_state.global_search_result
         if search_result:
-            sorted_search_result = sorted(search_result, key=lambda x: x['num_citations'], reverse=True)
+            # ranks everything found for the query so far, in any session
+            sorted_search_result = citation_cache.most_cited(st.session_state.search.last_content, 3) \
+                or sorted(search_result, key=lambda x: x.num_citations, reverse=True)
             st.write(f"#### {st.session_state.query_prompt}")
-            st.write("You may interested in (most cited from current search results):")
+            st.write("You may interested in (most cited papers found for this topic):")
             for article in sorted_search_result[:3]:
                 with st.container(border=True):
                     col_title, col_link, col_chat_btn = st.columns([6, 1, 2])
                     with col_title.container():
-                        st.write(f"**{article['title']}**")
+                        st.write(f"**{article.title}**")
                     with col_link.container():
-                        st.page_link(article['url'], label="🔗"
+                        st.page_link(article.url, label="🔗"
                                     , use_container_width=True)
                     with col_chat_btn.container():
                         st.button("Chat", use_container_width=True,
-                                key=f"interest_{article['id']}", on_click=start_chat_with_paper, args=(current_node, article))
+                                key=f"interest_{article.id}", on_click=start_chat_with_paper, args=(current_node, article))
                     with st.container(border=False):
-                        author_md = ", ".join([f"[{author['name']}]({author['citation_url']})" if author['id'] else author['name'] for author in article['authors']])
-                        st.write(f"{author_md} - {article['journal_ref']}, {article['publish_date']}, Cited by {article['num_citations']}")
-                        st.caption(f"**Abstract:** {article['abstract']}")
+                        author_md = author_markdown(article)
+                        st.write(f"{author_md} - {article.journal_ref}, {article.publish_date}, Cited by {article.num_citations}")
+                        st.caption(f"**Abstract:** {article.abstract}")
         
     for message in current_node.messages:
         if not message.skip:
@@ -345,10 +443,7 @@ with col_right.container():
             message = ChatMessage(role="assistant", message=response)
             current_node.messages.append(message)
         current_node.current_stream = None
-        if not current_node.related_questions:
-            get_paper_related_questions(current_node, response)
-        if not current_node.related_concepts:
-            get_paper_related_concepts(current_node, response)
+        schedule_paper_enrichments(current_node, response)
         st.rerun()
 
     if current_node.messages and not current_node.current_stream:
@@ -366,9 +461,7 @@ with col_right.container():
                     st.button(concept['concept'], on_click=on_related_concept, args=(
                         current_node, concept['concept']), key=concept['concept'], use_container_width=True)
         if chat := st.chat_input("对论文提问>"):
-            current_node.messages.append(ChatMessage("user", chat))
-            current_node.current_stream = chat_on_paper_with_moonshot(
-                current_node.paper_content, current_node.messages)
+            chat_on_paper(current_node, chat)
             st.rerun()
         st.divider()
         col1, col_summary_to_ppt, col_drop_paper = st.columns([2,1,1])
@@ -379,9 +472,16 @@ with col_right.container():
                 st.button("Summay into PPT", on_click=summarize_chat_to_single_slide, args=(current_node,), use_container_width=True)
         with col_drop_paper.container():
             popover = st.popover("Drop it", use_container_width=True)
-            popover.button("Confirm", on_click=remove_node, args=(current_node,), type="primary", use_container_width=True)
+            popover.button("Confirm", on_click=remove_node, args=(current_node.id,), type="primary", use_container_width=True)
 
     if query_on_start := st.session_state.query_on_start:
         st.session_state.query_on_start = ""
         do_query(query_on_start)
         st.rerun()
+
+if st.session_state.pending_search or st.session_state.pending_enrichments:
+    if st.session_state.pending_search:
+        poll_pending_search()
+    if st.session_state.pending_enrichments:
+        poll_pending_enrichments()
+    st.rerun()
@@ -0,0 +1,280 @@
+"""
+Asyncio counterparts of the helpers in llm.py.
+
+The coroutines share prompts and response parsing with llm.py and use
+AsyncOpenAI clients, so several calls can be in flight at once. Streamlit
+scripts are synchronous; they use the bridge at the bottom of this module
+(run_sync, gather_sync, submit, iter_sync) which runs coroutines on one
+background event loop owned by this module.
+"""
+
+import asyncio
+import threading
+import traceback
+import weakref
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, List, TypeVar
+
+import httpx
+import streamlit as st
+from loguru import logger
+from openai import AsyncOpenAI
+
+from llm import (_MISSING, MOONSHOT_API_BASE, RESPONSE_TTLS,
+                 _chat_on_paper_request, _compact_chat_history_request,
+                 _enrichment_request, _http_limits, _http_timeout,
+                 _is_answer_denying_query_request, _parse_enrichment,
+                 _parse_is_denying, _rag_query_request,
+                 _rag_with_metadata_request, _response_cache, _response_key,
+                 _split_rag_metadata, _visible_answer,
+                 _summarize_chat_request, _summarize_paper_request,
+                 _summarize_query_to_name_request,
+                 extract_file_with_moonshot)
+from structs import ChatMessage, PaperDocument
+
+T = TypeVar("T")
+
+# httpx async pools are bound to the event loop they were first used on, so
+# clients are pooled per loop and per (api_base, api_key).
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[tuple[str, str], AsyncOpenAI]]" = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def get_async_client(api_key: str, api_base: str = '') -> AsyncOpenAI:
+    loop = asyncio.get_running_loop()
+    key = (api_base, api_key)
+    with _clients_lock:
+        loop_clients = _clients.setdefault(loop, {})
+        client = loop_clients.get(key)
+        if client is None:
+            http_client = httpx.AsyncClient(
+                limits=_http_limits(), timeout=_http_timeout())
+            if api_base:
+                client = AsyncOpenAI(api_key=api_key, base_url=api_base,
+                                     http_client=http_client)
+            else:
+                client = AsyncOpenAI(api_key=api_key, http_client=http_client)
+            loop_clients[key] = client
+        return client
+
+
+def _openai_client() -> AsyncOpenAI:
+    return get_async_client(st.secrets['OPENAI_API_KEY'])
+
+
+def _moonshot_client() -> AsyncOpenAI:
+    return get_async_client(st.secrets['MOONSHOT_API_KEY'], MOONSHOT_API_BASE)
+
+
+# identical requests in flight, per loop like the clients
+_in_flight: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, asyncio.Future]]" = weakref.WeakKeyDictionary()
+
+
+async def _cached_response(helper: str, request: dict, compute: Callable[[dict], Awaitable[T]]) -> T:
+    """
+    Async counterpart of llm._cached_response, sharing its cache.
+    """
+    key = _response_key(helper, request)
+    value = await asyncio.to_thread(_response_cache.get, key, _MISSING, helper)
+    if value is not _MISSING:
+        return value
+    loop_in_flight = _in_flight.setdefault(asyncio.get_running_loop(), {})
+    if (future := loop_in_flight.get(key)) is not None:
+        return await asyncio.shield(future)
+    future = loop_in_flight[key] = asyncio.get_running_loop().create_future()
+    try:
+        value = await compute(request)
+        await asyncio.to_thread(_response_cache.set, key, value, RESPONSE_TTLS[helper])
+        future.set_result(value)
+        return value
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # nobody may be waiting, do not warn about an unretrieved exception
+        future.exception()
+        raise
+    finally:
+        loop_in_flight.pop(key, None)
+
+
+async def get_rag_query(query, contexts):
+    async def compute(request):
+        response = await _openai_client().chat.completions.create(**request)
+        return response.choices[0].message.content
+    return await _cached_response("rag_query", _rag_query_request(query, contexts), compute)
+
+
+async def get_rag_query_with_metadata(query, contexts, on_answer: Callable[[str], None] = None) -> dict:
+    """
+    See llm.get_rag_query_with_metadata.
+    """
+    async def compute(request):
+        text = ""
+        stream = await _openai_client().chat.completions.create(**request)
+        async for chunk in stream:
+            if chunk.choices and (delta := chunk.choices[0].delta.content):
+                text += delta
+                if on_answer:
+                    on_answer(_visible_answer(text))
+        answer, metadata = _split_rag_metadata(text)
+        if metadata is None:
+            logger.warning("rag answer came without usable metadata, asking separately")
+            denies_premise, name = await asyncio.gather(
+                is_answer_denying_query(query, answer), summarize_query_to_name(query))
+            metadata = {
+                "denies_premise": denies_premise,
+                "name": name,
+                "related_questions": [] if denies_premise else await get_related_questions(query, answer),
+            }
+        return dict(metadata, answer=answer)
+    return await _cached_response("rag_metadata", _rag_with_metadata_request(query, contexts), compute)
+
+
+async def get_enrichment(query, contexts) -> dict:
+    """
+    Gets related questions and related concepts based on the query and
+    context in a single request.
+    """
+    async def compute(request):
+        return _parse_enrichment(
+            await _openai_client().chat.completions.create(**request))
+    return await _cached_response("enrichment", _enrichment_request(query, contexts), compute)
+
+
+async def get_related_questions(query, contexts):
+    """
+    Gets related questions based on the query and context.
+    """
+    try:
+        return (await get_enrichment(query, contexts))["questions"]
+    except Exception as e:
+        # For any exceptions, we will just return an empty list.
+        logger.error(
+            "encountered error while generating related questions:"
+            f" {e}\n{traceback.format_exc()}"
+        )
+        return []
+
+
+async def get_related_concepts(query, contexts):
+    """
+    Gets related concepts based on the query and context.
+    """
+    try:
+        return (await get_enrichment(query, contexts))["concepts"]
+    except Exception as e:
+        # For any exceptions, we will just return an empty list.
+        logger.error(
+            "encountered error while generating related concepts:"
+            f" {e}\n{traceback.format_exc()}"
+        )
+        return []
+
+
+async def summarize_query_to_name(query: str):
+    async def compute(request):
+        response = await _openai_client().chat.completions.create(**request)
+        return response.choices[0].message.content
+    return await _cached_response("query_name", _summarize_query_to_name_request(query), compute)
+
+
+async def is_answer_denying_query(query: str, answer: str):
+    async def compute(request):
+        return _parse_is_denying(
+            await _openai_client().chat.completions.create(**request))
+    return await _cached_response(
+        "is_denying", _is_answer_denying_query_request(query, answer), compute)
+
+
+async def chat_on_paper_with_moonshot(paper: PaperDocument | str, messages: List[ChatMessage], full_context: bool = None, history_summary: str = ""):
+    """
+    Returns an async iterator of completion chunks.
+    """
+    return await _moonshot_client().chat.completions.create(
+        **_chat_on_paper_request(paper, messages, full_context, history_summary))
+
+
+async def summarize_paper_with_moonshot(filepath: str):
+    """
+    Returns an async iterator of completion chunks. Unlike the sync helper this
+    never removes the pdf, the caller owns the file.
+    """
+    # the extraction cache is shared with llm.py and is blocking file io
+    file_content = await asyncio.to_thread(extract_file_with_moonshot, filepath)
+    logger.info("sending chat to moonshot...")
+    return await _moonshot_client().chat.completions.create(
+        **_summarize_paper_request(file_content))
+
+
+async def compact_chat_history(history_summary: str, messages: List[ChatMessage]) -> str:
+    """
+    Folds chat messages into the running summary of a conversation.
+    """
+    response = await _moonshot_client().chat.completions.create(
+        **_compact_chat_history_request(history_summary, messages))
+    return response.choices[0].message.content
+
+
+async def summarize_chat(messages: List[ChatMessage]):
+    """
+    Returns an async iterator of completion chunks.
+    """
+    logger.info("sending chat to moonshot...")
+    return await _moonshot_client().chat.completions.create(
+        **_summarize_chat_request(messages))
+
+
+# Sync bridge
+
+_loop: asyncio.AbstractEventLoop = None
+_loop_lock = threading.Lock()
+
+
+def _bridge_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever,
+                             name="async-llm-loop", daemon=True).start()
+        return _loop
+
+
+def submit(coro: Awaitable[T]) -> "Future[T]":
+    """
+    Schedules a coroutine on the bridge loop and returns a concurrent future.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _bridge_loop())
+
+
+def run_sync(coro: Awaitable[T]) -> T:
+    """
+    Runs a coroutine on the bridge loop and blocks until it is done.
+    """
+    return submit(coro).result()
+
+
+def gather_sync(*coros: Awaitable[Any], return_exceptions: bool = False) -> List[Any]:
+    """
+    Runs several coroutines concurrently and returns their results in order.
+    """
+    async def _gather():
+        return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+    return run_sync(_gather())
+
+
+def iter_sync(aiterable: AsyncIterator[T] | Awaitable[AsyncIterator[T]]) -> Iterator[T]:
+    """
+    Turns an async iterator, or a coroutine returning one, into a blocking
+    generator, e.g. to feed an async stream to st.write_stream.
+    """
+    if asyncio.iscoroutine(aiterable):
+        aiterable = run_sync(aiterable)
+    aiterator = aiterable.__aiter__()
+    while True:
+        try:
+            yield run_sync(aiterator.__anext__())
+        except StopAsyncIteration:
+            return
@@ -0,0 +1,85 @@
+"""
+Token budgeting for chat prompts.
+
+Token counts are estimated rather than computed with the provider's
+tokenizer: Moonshot does not publish one, and the estimate only has to be
+good enough to pick a context window and decide what to leave out.
+"""
+
+import math
+import re
+from typing import Dict, List
+
+# CJK, kana, hangul and full width forms are roughly one token per character
+_wide_char_pattern = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]")
+# role markers and separators the api adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+MOONSHOT_CONTEXT_WINDOWS = [
+    ("moonshot-v1-8k", 8 * 1024),
+    ("moonshot-v1-32k", 32 * 1024),
+    ("moonshot-v1-128k", 128 * 1024),
+]
+# room left in the context window for the answer
+RESPONSE_RESERVE_TOKENS = 2048
+# once the unsummarized chat history grows past this, older turns are
+# folded into the node's running summary
+COMPACT_HISTORY_TOKENS = 6000
+# the most recent messages are always sent verbatim
+KEEP_RECENT_MESSAGES = 4
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    wide = len(_wide_char_pattern.findall(text))
+    return wide + math.ceil((len(text) - wide) / 4)
+
+
+def count_message_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def fit_history(messages: List[Dict[str, str]], max_tokens: int) -> List[Dict[str, str]]:
+    """
+    Returns the newest messages that fit into max_tokens. The last message,
+    the one being answered, is always kept.
+    """
+    kept = []
+    used = 0
+    for message in reversed(messages):
+        cost = count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+        if kept and used + cost > max_tokens:
+            break
+        kept.append(message)
+        used += cost
+    return kept[::-1]
+
+
+def fit_text(text: str, max_tokens: int) -> str:
+    """
+    Truncates text to about max_tokens.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    # shrink proportionally, then trim the rest of the estimate error
+    end = int(len(text) * max_tokens / count_tokens(text))
+    while end > 0 and count_tokens(text[:end]) > max_tokens:
+        end = int(end * 0.95)
+    return text[:max(end, 0)]
+
+
+def pick_moonshot_model(prompt_tokens: int) -> str:
+    """
+    Returns the smallest, hence fastest and cheapest, Moonshot model whose
+    context window fits the prompt and the answer.
+    """
+    for model, window in MOONSHOT_CONTEXT_WINDOWS:
+        if prompt_tokens + RESPONSE_RESERVE_TOKENS <= window:
+            return model
+    return MOONSHOT_CONTEXT_WINDOWS[-1][0]
+
+
+def needs_compaction(messages: List[Dict[str, str]]) -> bool:
+    return len(messages) > KEEP_RECENT_MESSAGES and \
+        count_message_tokens(messages) > COMPACT_HISTORY_TOKENS
@@ -0,0 +1,210 @@
+"""
+A small persistent cache shared by all sessions of the server process.
+
+Entries are JSON files under `<CACHE_DIR>/<namespace>/`, named by the hash
+of their key and written atomically, so concurrent sessions and processes
+never read a half-written entry.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import streamlit as st
+from loguru import logger
+
+_MISSING = object()
+
+
+def make_key(*parts: Any) -> str:
+    """
+    Hashes any JSON-serializable parts into a stable cache key.
+    """
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def file_digest(filepath: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Returns the sha256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_root() -> str:
+    return st.secrets.get("CACHE_DIR", ".taifu_cache")
+
+
+class DiskCache(object):
+    """
+    A namespaced key-value store on disk.
+
+    Args:
+        namespace: sub directory of the cache root holding the entries.
+        ttl: default time to live in seconds, None to keep entries forever.
+        max_entries: when set, the least recently used entries are evicted
+            once the namespace grows past this size.
+    """
+
+    def __init__(self, namespace: str, ttl: Optional[float] = None, max_entries: Optional[int] = None) -> None:
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._dir = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def dir(self) -> str:
+        if self._dir is None:
+            self._dir = os.path.join(cache_root(), self.namespace)
+            os.makedirs(self._dir, exist_ok=True)
+        return self._dir
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.dir, f"{make_key(key)}.json")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return default
+        except (OSError, ValueError) as e:
+            logger.warning(f"dropping unreadable cache entry {path}: {e}")
+            self._remove(path)
+            return default
+        expires = entry.get("expires")
+        if expires is not None and expires < time.time():
+            self._remove(path)
+            return default
+        if self.max_entries:
+            # mtime doubles as the last access time for LRU eviction
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return entry["value"]
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        entry = {
+            "key": key,
+            "created": time.time(),
+            "expires": time.time() + ttl if ttl is not None else None,
+            "value": value,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        if self.max_entries:
+            with self._lock:
+                self._writes += 1
+                # listing the directory is not free, only check now and then
+                should_evict = self._writes % 32 == 1
+            if should_evict:
+                self.evict()
+
+    def delete(self, key: str) -> None:
+        self._remove(self._path(key))
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries above max_entries.
+        """
+        entries = []
+        with os.scandir(self.dir) as it:
+            for e in it:
+                if e.name.endswith(".json"):
+                    try:
+                        entries.append((e.stat().st_mtime, e.path))
+                    except FileNotFoundError:
+                        continue
+        if self.max_entries and len(entries) > self.max_entries:
+            entries.sort()
+            for _, path in entries[:len(entries) - self.max_entries]:
+                self._remove(path)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class ResponseCache(object):
+    """
+    A DiskCache with an in-memory LRU tier in front of it, for small values
+    that are read far more often than written. Hits and misses are counted
+    per tag.
+
+    Args:
+        namespace: namespace of the disk tier.
+        max_in_memory: number of entries kept in memory.
+        max_entries: size limit of the disk tier.
+    """
+
+    def __init__(self, namespace: str, max_in_memory: int = 1024, max_entries: Optional[int] = None) -> None:
+        self.max_in_memory = max_in_memory
+        self._disk = DiskCache(namespace, max_entries=max_entries)
+        self._memory: "OrderedDict[str, tuple[Optional[float], Any]]" = OrderedDict()
+        self._counts: dict[str, list[int]] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, tag: str, hit: bool) -> None:
+        with self._lock:
+            counts = self._counts.setdefault(tag, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def _remember(self, key: str, expires: Optional[float], value: Any) -> None:
+        with self._lock:
+            self._memory[key] = (expires, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_in_memory:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str, default: Any = None, tag: str = "") -> Any:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] is None or entry[0] >= time.time():
+                    self._memory.move_to_end(key)
+                else:
+                    del self._memory[key]
+                    entry = None
+        if entry is None:
+            # the disk tier keeps the expiry, so promoted entries expire on time
+            if (entry := self._disk.get(key)) is not None:
+                entry = (entry["expires"], entry["value"])
+                self._remember(key, *entry)
+        self._count(tag, entry is not None)
+        return default if entry is None else entry[1]
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        expires = time.time() + ttl if ttl is not None else None
+        self._remember(key, expires, value)
+        self._disk.set(key, {"expires": expires, "value": value}, ttl=ttl)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        with self._lock:
+            return {tag: {"hits": hits, "misses": misses}
+                    for tag, (hits, misses) in self._counts.items()}
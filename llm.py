@@ -1,27 +1,39 @@
 import json
 import os
+import threading
 import time
 import traceback
+from concurrent.futures import Future
 from pathlib import Path
-from typing import List
+from typing import Callable, Iterator, List, TypeVar
 
+import httpx
 import streamlit as st
-from openai import OpenAI
+from openai import NotFoundError, OpenAI
 from typing_extensions import Annotated
 from loguru import logger
 
 import tool
-from structs import ChatMessage
+from budget import (MESSAGE_OVERHEAD_TOKENS, MOONSHOT_CONTEXT_WINDOWS,
+                    RESPONSE_RESERVE_TOKENS, count_message_tokens,
+                    fit_history, fit_text, pick_moonshot_model)
+from cache import DiskCache, ResponseCache, file_digest, make_key
+from retrieval import retrieve
+from structs import ChatMessage, PaperDocument
+
+T = TypeVar("T")
 
 
 class LLMModel(object):
-    def __init__(self, api_key: str,  model: str, model_params: dict[str, float | int] = {}, api_base: str = ''):
+    def __init__(self, api_key: str,  model: str, model_params: dict[str, float | int] = {}, api_base: str = '', client: OpenAI = None):
         super(LLMModel, self).__init__()
         self.api_key = api_key
         self.api_base = api_base
         self.model = model
         self.model_params = model_params
-        if api_base:
+        if client is not None:
+            self.client = client
+        elif api_base:
             self.client = OpenAI(api_key=self.api_key, base_url=api_base)
         else:
             self.client = OpenAI(api_key=self.api_key)
@@ -41,6 +53,126 @@ class LLMModel(object):
         return result
 
 
+MOONSHOT_API_BASE = "https://api.moonshot.cn/v1"
+
+# Process-wide registries. Streamlit re-executes the app scripts on every
+# rerun and for every session, but imported modules live as long as the
+# server process, so clients kept here reuse their keep-alive connections
+# across all of them.
+_clients: dict[tuple[str, str], OpenAI] = {}
+_models: dict[tuple[str, str, str], LLMModel] = {}
+_registry_lock = threading.Lock()
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=int(st.secrets.get("LLM_MAX_CONNECTIONS", 100)),
+        max_keepalive_connections=int(
+            st.secrets.get("LLM_MAX_KEEPALIVE_CONNECTIONS", 20)),
+        keepalive_expiry=float(st.secrets.get("LLM_KEEPALIVE_EXPIRY", 60)),
+    )
+
+
+def _http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        float(st.secrets.get("LLM_TIMEOUT", 120)),
+        connect=float(st.secrets.get("LLM_CONNECT_TIMEOUT", 10)),
+    )
+
+
+def _get_client(api_key: str, api_base: str = '') -> OpenAI:
+    key = (api_base, api_key)
+    with _registry_lock:
+        client = _clients.get(key)
+        if client is None:
+            http_client = httpx.Client(
+                limits=_http_limits(), timeout=_http_timeout())
+            if api_base:
+                client = OpenAI(api_key=api_key, base_url=api_base,
+                                http_client=http_client)
+            else:
+                client = OpenAI(api_key=api_key, http_client=http_client)
+            _clients[key] = client
+        return client
+
+
+def get_llm(api_key: str, model: str, api_base: str = '') -> LLMModel:
+    """
+    Returns the shared LLMModel for (api_base, api_key, model). Models on the
+    same endpoint and key share one OpenAI client and its connection pool.
+    """
+    key = (api_base, api_key, model)
+    llm = _models.get(key)
+    if llm is None:
+        client = _get_client(api_key, api_base)
+        with _registry_lock:
+            llm = _models.setdefault(key, LLMModel(
+                api_key=api_key, model=model, api_base=api_base, client=client))
+    return llm
+
+
+def _openai_llm(model: str = 'gpt-4-0125-preview') -> LLMModel:
+    return get_llm(api_key=st.secrets['OPENAI_API_KEY'], model=model)
+
+
+def _moonshot_llm(model: str) -> LLMModel:
+    return get_llm(api_key=st.secrets['MOONSHOT_API_KEY'], model=model,
+                   api_base=MOONSHOT_API_BASE)
+
+
+# parsed answers of the short helpers by request, shared by all sessions
+_response_cache = ResponseCache("llm_responses", max_in_memory=4096, max_entries=100000)
+# how long each helper's answers are reused, in seconds
+RESPONSE_TTLS = {
+    "rag_query": 24 * 3600,
+    "rag_metadata": 24 * 3600,
+    "enrichment": 7 * 24 * 3600,
+    "query_name": 30 * 24 * 3600,
+    "is_denying": 30 * 24 * 3600,
+}
+_in_flight: dict[str, Future] = {}
+_MISSING = object()
+
+
+def _response_key(helper: str, request: dict) -> str:
+    # the request holds model, messages, tools and sampling params
+    return make_key(helper, request)
+
+
+def _cached_response(helper: str, request: dict, compute: Callable[[dict], T]) -> T:
+    """
+    Returns the answer of an identical earlier request, or computes it once
+    with compute(request) and caches it. Concurrent identical requests wait
+    for the first one instead of calling the api again. Failures are not
+    cached.
+    """
+    key = _response_key(helper, request)
+    if (value := _response_cache.get(key, _MISSING, tag=helper)) is not _MISSING:
+        return value
+    with _registry_lock:
+        future = _in_flight.get(key)
+        owner = future is None
+        if owner:
+            future = _in_flight[key] = Future()
+    if not owner:
+        return future.result()
+    try:
+        value = compute(request)
+        _response_cache.set(key, value, ttl=RESPONSE_TTLS[helper])
+        future.set_result(value)
+        return value
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _registry_lock:
+            _in_flight.pop(key, None)
+
+
+def response_cache_stats() -> dict[str, dict[str, int]]:
+    return _response_cache.stats()
+
+
 _rag_query_text = """
 You are a large language AI assistant built by Lepton AI. You are given a user question, and please write clean, concise and accurate answer to the question. You will be given a set of related contexts to the question, each starting with a reference number like [[citation:x]], where x is a number. Please use the context and cite the context at the end of each sentence if applicable.
 
@@ -82,7 +214,12 @@ You are a helpful assistant that helps the user to ask related concepts about a
 """
 
 
-def get_rag_query(query, contexts):
+# The helpers below are split into a `_*_request` builder that returns the
+# keyword arguments of `chat.completions.create`, an optional `_parse_*`
+# function, and the call itself, so async_llm can share the prompts.
+
+
+def _rag_query_request(query, contexts) -> dict:
     stop_words = [
         "<|im_end|>",
         "[End]",
@@ -98,9 +235,7 @@ def get_rag_query(query, contexts):
                     c in enumerate(contexts)]
         )
     )
-    llm = LLMModel(
-        api_key=st.secrets['OPENAI_API_KEY'], model='gpt-4-0125-preview')
-    response = llm.client.chat.completions.create(
+    return dict(
         model="gpt-3.5-turbo",
         messages=[
             {"role": "system", "content": system_prompt},
@@ -109,62 +244,216 @@ def get_rag_query(query, contexts):
         max_tokens=1024,
         temperature=0.9,
     )
-    return response.choices[0].message.content
 
 
-def get_related_questions(query, contexts):
+def get_rag_query(query, contexts):
+    def compute(request):
+        response = _openai_llm().client.chat.completions.create(**request)
+        return response.choices[0].message.content
+    return _cached_response("rag_query", _rag_query_request(query, contexts), compute)
+
+
+# separates the answer from its metadata in rag answers with metadata
+RAG_METADATA_SENTINEL = "[[metadata]]"
+_rag_metadata_text = f"""
+After the answer, write a line containing only {RAG_METADATA_SENTINEL} followed by a json object and nothing else. The json object has these keys:
+"denies_premise": true if the answer says the premise of the question is wrong or the question does not hold, otherwise false.
+"name": the noun phrase of the question, in the same language as the question.
+"follow_ups": three follow-up questions of no more than 20 words each, in the same language as the question. Keep specifics like events, names and locations so each can be asked standalone, and do NOT repeat the original question.
+"""
+
+
+def _rag_with_metadata_request(query, contexts) -> dict:
+    request = _rag_query_request(query, contexts)
+    request["messages"].insert(1, {"role": "system", "content": _rag_metadata_text})
+    # the metadata follows the answer, the usual stop words would cut it off
+    request["stop"] = ["<|im_end|>"]
+    request["max_tokens"] = 1536
+    request["stream"] = True
+    return request
+
+
+def _visible_answer(text: str) -> str:
     """
-    Gets related questions based on the query and context.
+    The answer part of a partially streamed response, holding back what
+    may be the start of the sentinel.
     """
+    answer, sep, _ = text.partition(RAG_METADATA_SENTINEL)
+    return answer if sep else answer[:max(len(answer) - len(RAG_METADATA_SENTINEL), 0)]
 
-    def ask_related_questions(
-        questions: Annotated[List[str],
-                             [(
-                                 "question",
-                                 Annotated[str, "针对上下文的相关知识点提出的追问。"],
-                             )],
-                             ]
-    ):
-        """
-        ask further questions that are related to the input and output.
-        """
-        pass
 
+def _split_rag_metadata(text: str) -> tuple[str, dict]:
+    """
+    Splits a rag answer with metadata into the answer and the metadata, the
+    metadata is None if it is missing or malformed.
+    """
+    answer, sep, tail = text.partition(RAG_METADATA_SENTINEL)
+    if not sep:
+        return text.strip(), None
+    tail = tail.strip().removeprefix("```json").removeprefix("```").removesuffix("```")
     try:
-        llm = LLMModel(
-            api_key=st.secrets['OPENAI_API_KEY'], model='gpt-4-0125-preview')
-        response = llm.client.chat.completions.create(
-            # model="gpt-3.5-turbo",
-            model=llm.model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": _more_questions_prompt3
-                },
-                {
-                    "role": "user",
-                    "content": f"read this paper for me. {query}",
-                },
-                {
-                    "role": "assistant",
-                    "content": contexts
-                },
-                {
-                    "role": "user",
-                    "content": "I'll give you 500 dollars for better results. Give me THREE more related questions about the topics I might want to know."
-                }
-            ],
-            tools=[{
-                "type": "function",
-                "function": tool.get_tools_spec(ask_related_questions),
-            }],
-            max_tokens=1024,
-        )
-        related = response.choices[0].message.tool_calls[0].function.arguments
-        if isinstance(related, str):
-            related = json.loads(related)
-        logger.info(f"Related questions: {related}")
-        return related["questions"][:5]
+        metadata = json.loads(tail)
+    except ValueError:
+        return answer.strip(), None
+    if not isinstance(metadata, dict) \
+            or not isinstance(metadata.get("denies_premise"), bool) \
+            or not isinstance(metadata.get("name"), str) or not metadata["name"].strip() \
+            or not isinstance(metadata.get("follow_ups"), list):
+        return answer.strip(), None
+    return answer.strip(), {
+        "denies_premise": metadata["denies_premise"],
+        "name": metadata["name"].strip(),
+        # same shape as the ask_related_questions tool arguments
+        "related_questions": [{"question": q} for q in metadata["follow_ups"]
+                              if isinstance(q, str) and q.strip()][:5],
+    }
+
+
+def get_rag_query_with_metadata(query, contexts, on_answer: Callable[[str], None] = None) -> dict:
+    """
+    Answers the query like get_rag_query, and in the same streamed response
+    tells whether the answer denies the premise of the query, a name for it
+    and follow-up questions. on_answer gets the answer so far while it is
+    streamed. If the metadata is unusable it is filled in by the separate
+    helpers instead.
+    """
+    def compute(request):
+        text = ""
+        stream = _openai_llm().client.chat.completions.create(**request)
+        for chunk in stream:
+            if chunk.choices and (delta := chunk.choices[0].delta.content):
+                text += delta
+                if on_answer:
+                    on_answer(_visible_answer(text))
+        answer, metadata = _split_rag_metadata(text)
+        if metadata is None:
+            logger.warning("rag answer came without usable metadata, asking separately")
+            denies_premise = is_answer_denying_query(query, answer)
+            metadata = {
+                "denies_premise": denies_premise,
+                "name": summarize_query_to_name(query),
+                "related_questions": [] if denies_premise else get_related_questions(query, answer),
+            }
+        return dict(metadata, answer=answer)
+    return _cached_response("rag_metadata", _rag_with_metadata_request(query, contexts), compute)
+
+
+@tool.register
+def ask_related_questions(
+    questions: Annotated[List[str],
+                         [(
+                             "question",
+                             Annotated[str, "针对上下文的相关知识点提出的追问。"],
+                         )],
+                         ]
+):
+    """
+    ask further questions that are related to the input and output.
+    """
+    pass
+
+
+@tool.register
+def ask_related_concepts(
+    concepts: Annotated[List[str],
+                        [(
+                            "concept",
+                            Annotated[str, "Concept that metioned but not fully explained in the paper"],
+                        )],
+                        ]
+):
+    """
+    ask related concepts metioned but not fully explained in the paper.
+    """
+    pass
+
+
+@tool.register
+def check_is_denying(
+    is_denying: Annotated[bool, "答案有没有否定了原始问题"]
+) -> bool:
+    """
+    检查答案有没有否定原始问题。
+    """
+    pass
+
+
+def _tool_arguments(response) -> dict:
+    _, arguments = tool.decode(response.choices[0].message.tool_calls[0])
+    return arguments
+
+
+def _enrichment_request(query, contexts) -> dict:
+    # one request exposing both tools, the model answers with one call of each
+    return dict(
+        model='gpt-4-0125-preview',
+        messages=[
+            {
+                "role": "system",
+                "content": _more_questions_prompt3 + _more_concepts_prompt
+            },
+            {
+                "role": "user",
+                "content": f"read this paper for me. {query}",
+            },
+            {
+                "role": "assistant",
+                "content": contexts
+            },
+            {
+                "role": "user",
+                "content": "I'll give you 500 dollars for better results. Give me THREE more related questions about the topics I might want to know, "
+                           "and FIVE more related concepts mentioned in the paper that I might want to know more in other papers. "
+                           "Call ask_related_questions and ask_related_concepts once each."
+            }
+        ],
+        tools=[ask_related_questions.tool, ask_related_concepts.tool],
+        max_tokens=1024,
+    )
+
+
+def _parse_enrichment(response) -> dict:
+    """
+    Raises unless both tools were called, so partial answers are never
+    cached.
+    """
+    tool_calls = response.choices[0].message.tool_calls
+    if not tool_calls:
+        raise ValueError("enrichment answer has no tool calls: "
+                         f"{response.choices[0].message.content!r}")
+    enrichment = {}
+    for tool_call in tool_calls:
+        called, arguments = tool.decode(tool_call)
+        if called is ask_related_questions:
+            enrichment["questions"] = arguments["questions"][:5]
+        elif called is ask_related_concepts:
+            enrichment["concepts"] = arguments["concepts"][:5]
+    missing = [name for name, key in ((ask_related_questions.name, "questions"),
+                                      (ask_related_concepts.name, "concepts"))
+               if key not in enrichment]
+    if missing:
+        raise ValueError(f"enrichment answer did not call {', '.join(missing)}")
+    logger.info(f"Enrichment: {enrichment}")
+    return enrichment
+
+
+def get_enrichment(query, contexts) -> dict:
+    """
+    Gets related questions and related concepts based on the query and
+    context in a single request.
+    """
+    return _cached_response(
+        "enrichment", _enrichment_request(query, contexts),
+        lambda request: _parse_enrichment(
+            _openai_llm().client.chat.completions.create(**request)))
+
+
+def get_related_questions(query, contexts):
+    """
+    Gets related questions based on the query and context.
+    """
+    try:
+        return get_enrichment(query, contexts)["questions"]
     except Exception as e:
         # For any exceptions, we will just return an empty list.
         logger.error(
@@ -176,101 +465,132 @@ def get_related_questions(query, contexts):
 
 def get_related_concepts(query, contexts):
     """
-    Gets related concepts based on the query and context.
+    Gets related concepts based on the query and context. Shares the request
+    of get_related_questions, so asking for both costs one round trip.
     """
-
-    def ask_related_concepts(
-        concepts: Annotated[List[str],
-                            [(
-                                "concept",
-                                Annotated[str, "Concept that metioned but not fully explained in the paper"],
-                            )],
-                            ]
-    ):
-        """
-        ask related concepts metioned but not fully explained in the paper.
-        """
-        pass
-
     try:
-        llm = LLMModel(
-            api_key=st.secrets['OPENAI_API_KEY'], model='gpt-4-0125-preview')
-        response = llm.client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            # model=llm.model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": _more_concepts_prompt
-                },
-                {
-                    "role": "user",
-                    "content": f"read this paper for me. {query}",
-                },
-                {
-                    "role": "assistant",
-                    "content": contexts
-                },
-                {
-                    "role": "user",
-                    "content": "I'll give you 500 dollars for better results! Give me FIVE more related concepts mentioned in the paper that I might want to know more in other papers."
-                }
-            ],
-            tools=[{
-                "type": "function",
-                "function": tool.get_tools_spec(ask_related_concepts),
-            }],
-            max_tokens=1024,
-        )
-        related = response.choices[0].message.tool_calls[0].function.arguments
-        if isinstance(related, str):
-            related = json.loads(related)
-        logger.info(f"Related concepts: {related}")
-        return related["concepts"][:5]
+        return get_enrichment(query, contexts)["concepts"]
     except Exception as e:
         # For any exceptions, we will just return an empty list.
         logger.error(
-            "encountered error while generating related questions:"
+            "encountered error while generating related concepts:"
             f" {e}\n{traceback.format_exc()}"
         )
         return []
 
 
-def chat_on_paper_with_moonshot(paper_content: str, messages: List[ChatMessage]):
-    llm = LLMModel(
-        api_key=st.secrets['MOONSHOT_API_KEY'], model='moonshot-v1-128k', api_base="https://api.moonshot.cn/v1")
-    messages_for_completion = [
+def _retrieval_query(messages: List[ChatMessage]) -> str:
+    # follow-ups like "why?" need the previous question to find anything
+    questions = [m.message for m in messages if m.role == "user"]
+    return "\n".join(questions[-2:])
+
+
+def _chat_on_paper_request(paper: PaperDocument | str, messages: List[ChatMessage], full_context: bool = None, history_summary: str = "") -> dict:
+    """
+    Sends the whole paper when full_context is set (CHAT_FULL_CONTEXT secret
+    by default) or when only the legacy plain text is available, otherwise
+    only the chunks of the paper most relevant to the latest questions.
+
+    The prompt is budgeted: `messages` are the turns not yet folded into
+    `history_summary`, of which only the newest that fit CHAT_HISTORY_TOKENS
+    are sent, the paper gets what is left, and the smallest Moonshot model
+    that fits the result is used.
+    """
+    if full_context is None:
+        full_context = st.secrets.get("CHAT_FULL_CONTEXT", False)
+    preamble = [
         {
             "role": "system",
             "content": "You are Kimi, an AI paper reading assistant created by Moonshot."
         },
-        {
+    ]
+    if history_summary:
+        preamble.append({
             "role": "system",
-            "content": paper_content,
-        },
+            "content": f"Summary of the earlier conversation about this paper:\n{history_summary}",
+        })
+    reading_request = [
         {
             "role": "user",
             "content": "read this paper for me."
         }
     ]
-    messages_for_completion += [
+    history = [
         {
             "role": m.role,
             "content": m.message,
         } for m in messages
     ]
-    stream = llm.client.chat.completions.create(
-        model=llm.model,
+    history = fit_history(history, int(st.secrets.get("CHAT_HISTORY_TOKENS", 16000)))
+    if len(history) < len(messages):
+        logger.warning(f"chat history over budget, dropped {len(messages) - len(history)} messages")
+    fixed_tokens = count_message_tokens(preamble + reading_request + history) + MESSAGE_OVERHEAD_TOKENS
+    if isinstance(paper, str) or full_context:
+        paper_content = paper if isinstance(paper, str) else paper.text
+        paper_budget = MOONSHOT_CONTEXT_WINDOWS[-1][1] - RESPONSE_RESERVE_TOKENS - fixed_tokens
+        paper_content = fit_text(paper_content, paper_budget)
+    else:
+        chunks = retrieve(paper, _retrieval_query(messages),
+                          k=int(st.secrets.get("CHAT_RETRIEVAL_TOP_K", 6)),
+                          max_tokens=int(st.secrets.get("CHAT_PAPER_TOKENS", 4000)))
+        paper_content = "Relevant excerpts of the paper:\n\n" + \
+            "\n\n".join(chunk.to_context() for chunk in chunks)
+    messages_for_completion = preamble + [
+        {
+            "role": "system",
+            "content": paper_content,
+        }
+    ] + reading_request + history
+    return dict(
+        model=pick_moonshot_model(count_message_tokens(messages_for_completion)),
         messages=messages_for_completion,
         stream=True,
     )
+
+
+def chat_on_paper_with_moonshot(paper: PaperDocument | str, messages: List[ChatMessage], full_context: bool = None, history_summary: str = ""):
+    request = _chat_on_paper_request(paper, messages, full_context, history_summary)
+    llm = _moonshot_llm(request["model"])
+    stream = llm.client.chat.completions.create(**request)
     return stream
 
 
-def summarize_query_to_name(query: str):
-    llm = LLMModel(
-        api_key=st.secrets['OPENAI_API_KEY'], model='gpt-4-0125-preview')
-    response = llm.client.chat.completions.create(
+def _compact_chat_history_request(history_summary: str, messages: List[ChatMessage]) -> dict:
+    completion_messages = [
+        {
+            "role": "system",
+            "content": "You are Kimi, an AI chat summarizing assistant created by Moonshot."
+        },
+    ]
+    if history_summary:
+        completion_messages.append({
+            "role": "system",
+            "content": f"Summary of the conversation so far:\n{history_summary}",
+        })
+    completion_messages += [{"role": m.role, "content": m.message} for m in messages]
+    completion_messages.append({
+        "role": "user",
+        "content": "Merge the summary of the conversation so far and the chat messages above into one updated summary with bullet points. Keep every question I asked, the facts from the paper used to answer it and the conclusions, so the conversation can continue from the summary alone. ONLY output the summary."
+    })
+    return dict(
+        model='moonshot-v1-32k',
+        messages=completion_messages,
+        max_tokens=1024,
+    )
+
+
+def compact_chat_history(history_summary: str, messages: List[ChatMessage]) -> str:
+    """
+    Folds chat messages into the running summary of a conversation.
+    """
+    request = _compact_chat_history_request(history_summary, messages)
+    llm = _moonshot_llm(request["model"])
+    response = llm.client.chat.completions.create(**request)
+    return response.choices[0].message.content
+
+
+def _summarize_query_to_name_request(query: str) -> dict:
+    return dict(
         model="gpt-3.5-turbo",
         messages=[
             {
@@ -284,22 +604,18 @@ def summarize_query_to_name(query: str):
         ],
         max_tokens=512,
     )
-    return response.choices[0].message.content
 
 
-def is_answer_denying_query(query: str, answer: str):
-    llm = LLMModel(
-        api_key=st.secrets['OPENAI_API_KEY'], model='gpt-4-0125-preview')
-
-    def check_is_denying(
-        is_denying: Annotated[bool, "答案有没有否定了原始问题"]
-    ) -> bool:
-        """
-        检查答案有没有否定原始问题。
-        """
-        pass
-    response = llm.client.chat.completions.create(
-        model=llm.model,
+def summarize_query_to_name(query: str):
+    def compute(request):
+        response = _openai_llm().client.chat.completions.create(**request)
+        return response.choices[0].message.content
+    return _cached_response("query_name", _summarize_query_to_name_request(query), compute)
+
+
+def _is_answer_denying_query_request(query: str, answer: str) -> dict:
+    return dict(
+        model='gpt-4-0125-preview',
         messages=[
             {
                 "role": "system",
@@ -311,31 +627,27 @@ def is_answer_denying_query(query: str, answer: str):
             }
 
         ],
-        tools=[{
-            "type": "function",
-            "function": tool.get_tools_spec(check_is_denying),
-        }],
+        tools=[check_is_denying.tool],
         max_tokens=512,
     )
-    is_denying = response.choices[0].message.tool_calls[0].function.arguments
-    print(is_denying)
-    if isinstance(is_denying, str):
-        is_denying = json.loads(is_denying)
+
+
+def _parse_is_denying(response) -> bool:
+    is_denying = _tool_arguments(response)
+    logger.info(f"Is denying: {is_denying}")
     return is_denying['is_denying']
 
 
-def summarize_paper_with_moonshot(filepath: str, remove: bool = False):
-    llm = LLMModel(
-        api_key=st.secrets['MOONSHOT_API_KEY'], model='moonshot-v1-32k', api_base="https://api.moonshot.cn/v1")
-    logger.info("sending chat to moonshot...")
-    # llm = LLMModel(
-    #     api_key=st.secrets['OPENAI_API_KEY'], model='gpt-4-0125-preview')
-    # logger.info("sending chat to gpt4...")
-    file_object = llm.client.files.create(
-        file=Path(filepath), purpose="file-extract")
-    file_content = llm.client.files.content(file_id=file_object.id).text
-    stream = llm.client.chat.completions.create(
-        model=llm.model,
+def is_answer_denying_query(query: str, answer: str):
+    return _cached_response(
+        "is_denying", _is_answer_denying_query_request(query, answer),
+        lambda request: _parse_is_denying(
+            _openai_llm().client.chat.completions.create(**request)))
+
+
+def _summarize_paper_request(file_content: str) -> dict:
+    return dict(
+        model='moonshot-v1-32k',
         messages=[
             {
                 "role": "system",
@@ -391,18 +703,114 @@ this is conclusions.</details>
         ],
         stream=True,
     )
-    if remove and os.path.exists(filepath):
-        os.remove(filepath)
-    return stream
 
 
-def summarize_chat(messages: List[ChatMessage]):
-    llm = LLMModel(
-        api_key=st.secrets['MOONSHOT_API_KEY'], model='moonshot-v1-32k', api_base="https://api.moonshot.cn/v1")
+_summary_cache = DiskCache("paper_summaries")
+# extracted text by pdf digest, least recently used entries are evicted
+_extract_cache = DiskCache("moonshot_extracts", max_entries=2000)
+# moonshot file id by pdf digest
+_remote_files = DiskCache("moonshot_files")
+# striped by pdf digest, a fixed set instead of one lock per paper ever seen
+_extract_locks = [threading.Lock() for _ in range(64)]
+
+
+def _prune_remote_files(llm: LLMModel, keep: str) -> None:
+    """
+    Deletes the oldest files on Moonshot once more than
+    MOONSHOT_MAX_REMOTE_FILES are stored there.
+    """
+    max_files = int(st.secrets.get("MOONSHOT_MAX_REMOTE_FILES", 500))
+    files = sorted(llm.client.files.list().data, key=lambda f: f.created_at)
+    for file_object in files[:max(len(files) - max_files, 0)]:
+        if file_object.id == keep:
+            continue
+        logger.info(f"deleting moonshot file {file_object.id}...")
+        try:
+            llm.client.files.delete(file_id=file_object.id)
+        except NotFoundError:
+            pass
+
+
+def extract_file_with_moonshot(filepath: str, digest: str = "") -> str:
+    """
+    Returns the text Moonshot extracts from a file. The text is cached locally
+    by the file digest, and the remote file is reused while it still exists,
+    so a file is uploaded and extracted at most once.
+    """
+    digest = digest or file_digest(filepath)
+    with _extract_locks[hash(digest) % len(_extract_locks)]:
+        if (text := _extract_cache.get(digest)) is not None:
+            return text
+        llm = _moonshot_llm('moonshot-v1-32k')
+        text = None
+        if file_id := _remote_files.get(digest):
+            try:
+                text = llm.client.files.content(file_id=file_id).text
+            except NotFoundError:
+                logger.info(f"moonshot file {file_id} is gone, uploading again...")
+                _remote_files.delete(digest)
+        if text is None:
+            logger.info(f"uploading file to moonshot... {filepath}")
+            file_object = llm.client.files.create(
+                file=Path(filepath), purpose="file-extract")
+            _remote_files.set(digest, file_object.id)
+            text = llm.client.files.content(file_id=file_object.id).text
+            try:
+                _prune_remote_files(llm, keep=file_object.id)
+            except Exception as e:
+                logger.warning(f"failed to prune moonshot files: {e}")
+        _extract_cache.set(digest, text)
+        return text
+
+
+def _summary_prompt_version() -> str:
+    # any change to the summary prompt or model yields a new version
+    return make_key(_summarize_paper_request(""))
+
+
+def _replay_stream(text: str, chunk_size: int = 64) -> Iterator[str]:
+    for i in range(0, len(text), chunk_size):
+        yield text[i:i + chunk_size]
+
+
+def _record_stream(stream, on_complete: Callable[[str], None]):
+    """
+    Passes the chunks of a completion stream through and calls on_complete
+    with the full text, only if the stream was consumed to the end and was
+    not empty.
+    """
+    parts = []
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+        yield chunk
+    if parts:
+        on_complete("".join(parts))
+
+
+def summarize_paper_with_moonshot(filepath: str, remove: bool = False):
+    digest = file_digest(filepath)
+    cache_key = make_key(digest, _summary_prompt_version())
+    if (summary := _summary_cache.get(cache_key)) is not None:
+        logger.info("replaying cached paper summary...")
+        if remove and os.path.exists(filepath):
+            os.remove(filepath)
+        return _replay_stream(summary)
+    llm = _moonshot_llm('moonshot-v1-32k')
+    file_content = extract_file_with_moonshot(filepath, digest)
     logger.info("sending chat to moonshot...")
     # llm = LLMModel(
     #     api_key=st.secrets['OPENAI_API_KEY'], model='gpt-4-0125-preview')
     # logger.info("sending chat to gpt4...")
+    stream = llm.client.chat.completions.create(
+        **_summarize_paper_request(file_content))
+    if remove and os.path.exists(filepath):
+        os.remove(filepath)
+    return _record_stream(
+        stream, lambda summary: _summary_cache.set(cache_key, summary))
+
+
+def _summarize_chat_request(messages: List[ChatMessage]) -> dict:
     completion_messages = [
         {
             "role": "system",
@@ -414,9 +822,19 @@ def summarize_chat(messages: List[ChatMessage]):
         "role": "user",
         "content": "I will tip you 500 dollars again for a better result! Summarize our previous chat messages into bullet points in my voice. You must keep the conclusion and my opinion from our chat and keep them short so they can be put into a single slide. ONLY output the summary. Remember, this is very important to me."
     })
-    stream = llm.client.chat.completions.create(
-        model=llm.model,
+    return dict(
+        model='moonshot-v1-32k',
         messages=completion_messages,
         stream=True,
     )
+
+
+def summarize_chat(messages: List[ChatMessage]):
+    llm = _moonshot_llm('moonshot-v1-32k')
+    logger.info("sending chat to moonshot...")
+    # llm = LLMModel(
+    #     api_key=st.secrets['OPENAI_API_KEY'], model='gpt-4-0125-preview')
+    # logger.info("sending chat to gpt4...")
+    stream = llm.client.chat.completions.create(
+        **_summarize_chat_request(messages))
     return stream
@@ -0,0 +1,159 @@
+"""
+Local lexical retrieval over a paper, so a chat turn only needs to send the
+parts of the paper relevant to the question instead of the whole text.
+"""
+
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from budget import count_tokens
+from structs import PaperDocument
+
+# latin words and numbers, plus single CJK characters since Chinese text has
+# no spaces to split on
+_token_pattern = re.compile(r"[a-z0-9]+|[\u4e00-\u9fff]")
+_stop_words = frozenset("""
+a an and are as at be by can do does for from has have how in is it its of on
+or that the their this to was we were what when where which who why will with
+""".split())
+_reference_titles = ("references", "bibliography")
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _token_pattern.findall(text.lower()) if t not in _stop_words]
+
+
+@dataclass
+class Chunk(object):
+    index: int = 0
+    start: int = 0  # offsets in PaperDocument.text
+    end: int = 0
+    page: int = 0
+    section: str = ""
+    text: str = ""
+
+    def to_context(self) -> str:
+        where = f"page {self.page}"
+        if self.section:
+            where += f", {self.section}"
+        return f"[{where}]\n{self.text}"
+
+
+def chunk_document(doc: PaperDocument, size: int = 1200, overlap: int = 200) -> List[Chunk]:
+    """
+    Splits a paper into overlapping chunks of about `size` characters,
+    breaking at paragraph or line ends where possible. The references
+    section is left out, it only adds noise to lexical matching.
+    """
+    text = doc.text
+    end_of_body = len(text)
+    for section in doc.sections:
+        if section.title.lower().lstrip("0123456789. ") in _reference_titles:
+            end_of_body = min(end_of_body, section.start)
+    chunks = []
+    start = 0
+    while start < end_of_body:
+        end = min(start + size, end_of_body)
+        if end < end_of_body:
+            window = text[start + size // 2:end]
+            for sep in ("\n\n", "\n", ". ", " "):
+                cut = window.rfind(sep)
+                if cut >= 0:
+                    end = start + size // 2 + cut + len(sep)
+                    break
+        chunk_text = text[start:end].strip()
+        if chunk_text:
+            page = doc.page_at(start)
+            section = doc.section_at(start)
+            chunks.append(Chunk(
+                index=len(chunks), start=start, end=end,
+                page=page.number if page else 0,
+                section=section.title if section else "",
+                text=chunk_text))
+        if end >= end_of_body:
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+class BM25Index(object):
+    """
+    Okapi BM25 over the chunks of one paper.
+    """
+
+    def __init__(self, chunks: List[Chunk], k1: float = 1.5, b: float = 0.75) -> None:
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._lengths = []
+        for chunk in chunks:
+            terms = Counter(tokenize(chunk.text))
+            self._lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                self._postings.setdefault(term, []).append((chunk.index, tf))
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0
+        n = len(chunks)
+        self._idf = {
+            term: math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+
+    def search(self, query: str, k: int = 6) -> List[Tuple[float, Chunk]]:
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for index, tf in self._postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[index] / self._avg_length)
+                scores[index] = scores.get(index, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(score, self.chunks[index]) for index, score in best]
+
+
+_indexes: OrderedDict[str, BM25Index] = OrderedDict()
+_indexes_lock = threading.Lock()
+_MAX_INDEXES = 32
+
+
+def get_index(doc: PaperDocument) -> BM25Index:
+    """
+    Returns the index of a paper, built once and shared by all sessions.
+    """
+    with _indexes_lock:
+        if index := _indexes.get(doc.id):
+            _indexes.move_to_end(doc.id)
+            return index
+    index = BM25Index(chunk_document(doc))
+    with _indexes_lock:
+        _indexes[doc.id] = index
+        while len(_indexes) > _MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def retrieve(doc: PaperDocument, query: str, k: int = 6, max_tokens: int = None) -> List[Chunk]:
+    """
+    Returns the chunks most relevant to the query in reading order. The
+    first chunk, which holds the title and abstract, is always included.
+    With max_tokens, lower ranked chunks are dropped until the rest fit.
+    """
+    index = get_index(doc)
+    if not index.chunks:
+        return []
+    ranked = [index.chunks[0]] + [chunk for _, chunk in index.search(query, k)
+                                  if chunk.index != 0]
+    chunks = []
+    used = 0
+    for chunk in ranked:
+        cost = count_tokens(chunk.text)
+        if max_tokens is not None and chunks and used + cost > max_tokens:
+            break
+        chunks.append(chunk)
+        used += cost
+    return sorted(chunks, key=lambda chunk: chunk.index)
@@ -1,99 +1,213 @@
-import os
-from typing import List
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import date, datetime, timezone
+from typing import Iterable, Iterator, List
 
-import feedparser
-import fitz
 import requests
-import streamlit as st
-from dateutil import parser
 from loguru import logger
 
+from search.download import download_pdf
+from search.pdf import extract_document, extract_text
+from structs import Article, Author, PaperDocument
+
+
+API_URL = "http://export.arxiv.org/api/query"
+# arXiv asks api clients to wait 3 seconds between requests
+REQUEST_INTERVAL = 3.0
+# arXiv refuses to page past this many results of one query
+MAX_START = 30000
+FIELDS = ("all", "ti", "au", "abs", "co", "jr", "cat", "rn", "id")
+_field_prefix_pattern = re.compile(rf"^(?:{'|'.join(FIELDS)}):", re.IGNORECASE)
+_atom = "{http://www.w3.org/2005/Atom}"
+_arxiv = "{http://arxiv.org/schemas/atom}"
+_timestamp_format = "%Y-%m-%dT%H:%M:%SZ"
+_sort_by = {
+    "relevance": "relevance",
+    "date": "submittedDate",
+    "submitted": "submittedDate",
+    "updated": "lastUpdatedDate",
+}
+
+_session = requests.Session()
+_pace_lock = threading.Lock()
+_last_request = 0.0
+
+
+def _paced_get(params: dict, timeout: float = 30, stream: bool = False) -> requests.Response:
+    """
+    GETs the api, keeping REQUEST_INTERVAL between requests of all sessions.
+    """
+    global _last_request
+    with _pace_lock:
+        delay = _last_request + REQUEST_INTERVAL - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        _last_request = time.monotonic()
+    response = _session.get(API_URL, params=params, timeout=timeout, stream=stream)
+    response.raise_for_status()
+    return response
+
+
+def build_query(content: str | List[str], field: str = "all", categories: List[str] = None,
+                date_from: date = None, date_to: date = None) -> str:
+    """
+    Builds an api search_query. Every term is searched in `field` unless it
+    already names one, e.g. "ti:transformer" or "au:hinton". Terms,
+    categories and the submission date range are ANDed.
+    """
+    if field not in FIELDS:
+        raise ValueError(f"unknown arxiv search field {field}, use one of {FIELDS}")
+    terms = [content] if isinstance(content, str) else list(content)
+    clauses = [term if _field_prefix_pattern.match(term) else f"{field}:{term}"
+               for term in terms if term.strip()]
+    if categories:
+        clauses.append("(" + " OR ".join(f"cat:{c}" for c in categories) + ")")
+    if date_from or date_to:
+        start = (date_from or date(1991, 1, 1)).strftime("%Y%m%d0000")
+        end = (date_to or date.today()).strftime("%Y%m%d2359")
+        clauses.append(f"submittedDate:[{start} TO {end}]")
+    return " AND ".join(clauses)
+
+
+def _parse_timestamp(value: str) -> datetime:
+    # the api always uses this exact format, no need for a generic parser
+    return datetime.strptime(value.strip(), _timestamp_format).replace(tzinfo=timezone.utc)
+
+
+def _build_article(entry: ET.Element) -> Article:
+    url = entry.findtext(f"{_atom}id", "").strip()
+    pdf_url = 'http://arxiv.org/pdf/%s' % url.split('/abs/')[-1]
+    for link in entry.iter(f"{_atom}link"):
+        if link.get('title') == 'pdf':
+            pdf_url = link.get('href')
+        elif link.get('rel') == 'alternate':
+            url = link.get('href')
+    primary_category = entry.find(f"{_arxiv}primary_category")
+    return Article(
+        id=url.split('/abs/')[-1],
+        term=primary_category.get('term') if primary_category is not None else '',
+        terms='|'.join(tag.get('term') for tag in entry.iter(f"{_atom}category")),
+        authors=[Author(name=author.findtext(f"{_atom}name", ""))
+                 for author in entry.iter(f"{_atom}author")],
+        url=url,
+        pdf_url=pdf_url,
+        title=' '.join(entry.findtext(f"{_atom}title", "").split()),
+        abstract=entry.findtext(f"{_atom}summary", "").replace('\n', ' ').strip(),
+        update_date=_parse_timestamp(entry.findtext(f"{_atom}updated")),
+        publish_date=_parse_timestamp(entry.findtext(f"{_atom}published")),
+        comment=entry.findtext(f"{_arxiv}comment") or 'No comment found',
+        journal_ref=entry.findtext(f"{_arxiv}journal_ref") or 'No journal ref found')
+
+
+def iter_entries(chunks: Iterable[bytes]) -> Iterator[Article]:
+    """
+    Incrementally parses an api Atom feed, yielding each entry as an Article
+    as soon as its closing tag has arrived.
+    """
+    parser = ET.XMLPullParser(events=("end",))
+    for chunk in chunks:
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            if element.tag != f"{_atom}entry":
+                continue
+            if element.findtext(f"{_atom}title") == 'Error':
+                logger.error('Error %s' % element.findtext(f"{_atom}summary"))
+            else:
+                yield _build_article(element)
+            # entries are done with, keep memory flat on large responses
+            element.clear()
+    parser.close()
+
+
+class _ArxivQuery(object):
+    """
+    Api params of one search and the results handed out so far. A replaced
+    query still streaming in another thread only moves its own offset.
+    """
+
+    def __init__(self, params: dict, offset: int = 0) -> None:
+        self.params = params
+        self.offset = offset
+
 
 class ArxivSearch(object):
     """
     see also: https://info.arxiv.org/help/api/user-manual.html
     """
 
-    def search(self, content: str | List[str]):
-        search_query = f"all:{content}"
-        if isinstance(content, list):
-            search_query = "+AND+".join([f"all:{e}" for e in content])
-        search_query = search_query.replace(" ", "+")
-        logger.info(f"Start ARXIV query: {search_query}")
-        # articles = arxivpy.query(
-        #     search_query=search_query, results_per_iteration=20, max_index=20, sort_by="relevance")
-        articles = []
-        response = requests.get(
-            f"http://export.arxiv.org/api/query?search_query={search_query}&sortBy=relevance")
-        entries = feedparser.parse(response.content.decode())
-        for entry in entries['entries']:
-            if entry['title'] == 'Error':
-                print('Error %s' % entry['summary'])
-            main_term = entry['arxiv_primary_category']['term']
-            terms = '|'.join([tag['term'] for tag in entry['tags']])
-            main_author = entry['author']
-            update_date = parser.parse(entry['updated'])
-            authors = ', '.join([author['name'].strip()
-                                for author in entry['authors']])
-            url = entry['link']
-            for e in entry['links']:
-                if 'title' in e.keys():
-                    if e['title'] == 'pdf':
-                        pdf_url = e['href']
-                else:
-                    pdf_url = 'http://arxiv.org/pdf/%s' % url.split(
-                        '/abs/')[-1]
-            if 'arxiv_comment' in entry.keys():
-                comment = entry['arxiv_comment']
-            else:
-                comment = 'No comment found'
-            if 'journal_ref' in entry.keys():
-                journal_ref = entry['journal_ref']
-            else:
-                journal_ref = 'No journal ref found'
-
-            title = entry['title_detail']['value'].replace('\n', ' ').strip()
-            abstract = entry['summary'].replace('\n', ' ')
-            publish_date = parser.parse(entry['published'])
-            article = {'id': url.split('/abs/')[-1],
-                       'term': main_term,
-                       'terms': terms,
-                       'main_author': main_author,
-                       'authors': authors,
-                       'url': url,
-                       'pdf_url': pdf_url,
-                       'title': title,
-                       'abstract': abstract,
-                       'update_date': update_date,
-                       'publish_date': publish_date,
-                       'comment': comment,
-                       'journal_ref': journal_ref}
-            articles.append(article)
-        logger.info(f"found {len(articles)} articles")
+    def __init__(self) -> None:
+        self._last_query: _ArxivQuery = None  # the last search, for more()
+
+    def search(self, content: str | List[str], year_from: int = None, sort_by: str = "relevance",
+               start: int = 0, max_results: int = 10, field: str = "all", categories: List[str] = None,
+               date_from: date = None, date_to: date = None, sort_order: str = "descending"):
+        return list(self.stream_search(
+            content, year_from, sort_by, start, max_results, field, categories,
+            date_from, date_to, sort_order))
+
+    def stream_search(self, content: str | List[str], year_from: int = None, sort_by: str = "relevance",
+                      start: int = 0, max_results: int = 10, field: str = "all", categories: List[str] = None,
+                      date_from: date = None, date_to: date = None, sort_order: str = "descending") -> Iterator[Article]:
+        """
+        Same as search(), but yields articles while the response is still
+        arriving.
+        """
+        if year_from and not date_from:
+            date_from = date(year_from, 1, 1)
+        query = self._last_query = _ArxivQuery({
+            "search_query": build_query(content, field, categories, date_from, date_to),
+            "sortBy": _sort_by.get(sort_by, sort_by),
+            "sortOrder": sort_order,
+        }, start)
+        for article in self._query(query.params, start, max_results):
+            query.offset += 1
+            yield article
+
+    def more(self, length: int = 10):
+        query = self._last_query
+        if not query:
+            logger.warning(f"no last query")
+            return []
+        articles = list(self._query(query.params, query.offset, length))
+        query.offset += len(articles)
         return articles
 
-    def download_and_read(self, article: dict) -> str:
-        pdf_dir = "arxiv_pdf"
-        if not os.path.isdir(pdf_dir):
-            os.mkdir(pdf_dir)
-        filename = f"{pdf_dir}/{article['id'] + '.pdf'}"
-        logger.info(f"downloading arxiv pdf... {filename}")
-        if not os.path.exists(filename):
-            pdf_url = article['pdf_url']
-            if mirror_url := st.secrets.get("ARXIV_DOWNLOAD_URL", ""):
-                pdf_url = article['pdf_url'].replace(
-                    "https://arxiv.org", mirror_url)
-            r = requests.get(article['pdf_url'].replace(
-                "html", "pdf"), allow_redirects=True)
-            with open(filename, "wb") as f:
-                f.write(r.content)
-        text = ""
-        logger.info(f"reading pdf...")
-        with fitz.open(filename) as doc:
-            for page in doc:
-                text += page.get_text()
-        logger.info(f"reading pdf...done")
-        return text
+    def iter_search(self, content: str | List[str], page_size: int = 100, limit: int = None, **kwargs) -> Iterator[Article]:
+        """
+        Yields the articles of a query page by page, up to limit articles.
+        Takes the same keyword arguments as search().
+        """
+        start = kwargs.pop("start", 0)
+        yielded = 0
+        while limit is None or yielded < limit:
+            size = page_size if limit is None else min(page_size, limit - yielded)
+            count = 0
+            for article in self.stream_search(content, start=start, max_results=size, **kwargs):
+                count += 1
+                yield article
+            yielded += count
+            start += count
+            if count < size or start >= MAX_START:
+                return
+
+    @staticmethod
+    def _query(params: dict, start: int, max_results: int) -> Iterator[Article]:
+        params = dict(params, start=start, max_results=max_results)
+        logger.info(f"Start ARXIV query: {params}")
+        count = 0
+        with _paced_get(params, stream=True) as response:
+            for article in iter_entries(response.iter_content(chunk_size=16 * 1024)):
+                count += 1
+                yield article
+        logger.info(f"found {count} articles")
+
+    def download_and_read(self, article: Article) -> str:
+        return extract_text(download_pdf(article))
+
+    def download_and_parse(self, article: Article) -> PaperDocument:
+        return extract_document(download_pdf(article))
 
 
 if __name__ == "__main__":
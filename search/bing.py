@@ -1,24 +1,86 @@
-import requests
+import asyncio
+import threading
+import weakref
+
+import httpx
+
+from cache import DiskCache
+
+SEARCH_URL = "https://api.bing.microsoft.com/v7.0/search"
+
+# web results by (q, mkt), shared by all sessions
+_search_cache = DiskCache("bing_search")
+
 
 class BingSearch(object):
-    def __init__(self, sub_key: str) -> None:
+    """
+    Bing web search over pooled connections. The client keeps no per-query
+    state, so concurrent searches from several threads or tasks are safe.
+    """
+
+    def __init__(self, sub_key: str, cache_ttl: float = 24 * 3600) -> None:
         self.sub_key = sub_key
+        self.cache_ttl = cache_ttl
         self._headers = {"Ocp-Apim-Subscription-Key": self.sub_key}
-        self._params = {"q": "", "textDecorations": True,
-                        "textFormat": "HTML", "mkt": "zh-CN"}
-        self._search_url = "https://api.bing.microsoft.com/v7.0/search"
+        self._client = httpx.Client(headers=self._headers, timeout=30)
+        # httpx async pools are bound to the event loop they were first used on
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _params(q: str, mkt: str) -> dict:
+        return {"q": q, "textDecorations": True, "textFormat": "HTML", "mkt": mkt}
+
+    def _async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = httpx.AsyncClient(headers=self._headers, timeout=30)
+                self._async_clients[loop] = client
+            return client
 
     def search(self, q, mkt="zh-CN"):
         if not q:
             return []
-        self._params["q"] = q
-        self._params["mkt"] = mkt
-        response = requests.get(
-            self._search_url, headers=self._headers, params=self._params)
+        cache_key = f"{mkt}:{q}"
+        if (result := _search_cache.get(cache_key)) is not None:
+            return result
+        response = self._client.get(SEARCH_URL, params=self._params(q, mkt))
+        response.raise_for_status()
+        result = response.json()['webPages']
+        _search_cache.set(cache_key, result, ttl=self.cache_ttl)
+        return result
+
+    async def asearch(self, q, mkt="zh-CN"):
+        if not q:
+            return []
+        cache_key = f"{mkt}:{q}"
+        if (result := await asyncio.to_thread(_search_cache.get, cache_key)) is not None:
+            return result
+        response = await self._async_client().get(SEARCH_URL, params=self._params(q, mkt))
         response.raise_for_status()
-        return response.json()['webPages']
-    
+        result = response.json()['webPages']
+        await asyncio.to_thread(_search_cache.set, cache_key, result, self.cache_ttl)
+        return result
+
+
+_searches: dict[str, BingSearch] = {}
+_searches_lock = threading.Lock()
+
+
+def get_bing_search(sub_key: str) -> BingSearch:
+    """
+    Returns the process-wide client of a subscription key, so every session
+    and rerun shares one connection pool.
+    """
+    with _searches_lock:
+        if (search := _searches.get(sub_key)) is None:
+            search = _searches[sub_key] = BingSearch(sub_key)
+        return search
+
+
 if __name__ == "__main__":
     bing = BingSearch("c708ee5eda474c93b8b515ae07654941")
     result = bing.search("优质快网络技术咨询（上海）有限公司")
-    print(result)
\ No newline at end of file
+    print(result)
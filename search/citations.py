@@ -0,0 +1,193 @@
+"""
+Author profiles and citation counts from Google Scholar, cached on disk and
+shared by all sessions.
+
+Lookups are lazy: an author profile is fetched when it is rendered, a
+citation count when the "most cited" panel shows the paper. They run one at
+a time in the background, at least SCHOLAR_LOOKUP_INTERVAL seconds apart
+and at most SCHOLAR_LOOKUP_QUEUE waiting, since they share the ip with the
+main Scholar search. Every author or paper is fetched at most once per TTL
+no matter how many sessions show it, and failed lookups are not retried for
+SCHOLAR_FAILURE_TTL. Articles seen for a query are remembered, so "most
+cited" ranks everything found for the query so far instead of only the
+current result page.
+"""
+
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import streamlit as st
+from loguru import logger
+from scholarly import scholarly
+
+from cache import DiskCache
+from structs import Article
+
+_non_word_pattern = re.compile(r"\W+")
+
+# one worker, Scholar blocks clients that query too fast
+_lookup_executor = ThreadPoolExecutor(1, thread_name_prefix="scholar-lookup")
+_pace_lock = threading.Lock()
+_last_lookup = 0.0
+
+_author_cache = DiskCache("scholar_authors", max_entries=20000)
+_citation_cache = DiskCache("scholar_citations", max_entries=50000)
+_query_cache = DiskCache("scholar_query_articles", max_entries=5000)
+# lookups that failed recently, by task key
+_failed_lookups = DiskCache("scholar_failed_lookups", max_entries=5000)
+
+
+def _author_ttl() -> float:
+    return float(st.secrets.get("SCHOLAR_AUTHOR_TTL", 7 * 24 * 3600))
+
+
+def _citation_ttl() -> float:
+    return float(st.secrets.get("SCHOLAR_CITATION_TTL", 3 * 24 * 3600))
+
+
+def _failure_ttl() -> float:
+    return float(st.secrets.get("SCHOLAR_FAILURE_TTL", 15 * 60))
+
+
+def _max_queued() -> int:
+    return int(st.secrets.get("SCHOLAR_LOOKUP_QUEUE", 20))
+
+
+def _pace() -> None:
+    """
+    Waits until SCHOLAR_LOOKUP_INTERVAL has passed since the last lookup.
+    """
+    global _last_lookup
+    interval = float(st.secrets.get("SCHOLAR_LOOKUP_INTERVAL", 10))
+    with _pace_lock:
+        delay = _last_lookup + interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        _last_lookup = time.monotonic()
+
+
+def _normalize(text: str) -> str:
+    return _non_word_pattern.sub(" ", text.lower()).strip()
+
+
+def article_key(article: Article) -> str:
+    # title based, so the arxiv and scholar copies of a paper share counts
+    return _normalize(article.title)
+
+
+class CitationCache(object):
+    """
+    Fills author profiles and cited-by counts in the background, on demand,
+    and ranks the articles seen for a query by citations.
+    """
+
+    def __init__(self) -> None:
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def author(self, author_id: str) -> dict:
+        """
+        Returns the cached profile of a Scholar author. Otherwise returns
+        None and queues a lookup, unless the last one failed recently.
+        """
+        if not author_id:
+            return None
+        if (profile := _author_cache.get(author_id)) is not None:
+            return profile
+        self._submit(f"author:{author_id}", self._fetch_author, author_id)
+        return None
+
+    def num_citations(self, article: Article) -> int:
+        cached = _citation_cache.get(article_key(article))
+        return max(article.num_citations, cached or 0)
+
+    def record(self, query: str, articles: List[Article]) -> None:
+        """
+        Remembers the articles found for a query and the citation counts
+        they carry. Nothing is fetched here.
+        """
+        if not articles:
+            return
+        key = _normalize(query)
+        with self._lock:
+            seen: Dict[str, dict] = _query_cache.get(key) or {}
+            for article in articles:
+                seen[article_key(article)] = article.to_json()
+            _query_cache.set(key, seen, ttl=_citation_ttl())
+        for article in articles:
+            if article.num_citations and \
+                    _citation_cache.get(article_key(article)) != article.num_citations:
+                _citation_cache.set(article_key(article), article.num_citations, ttl=_citation_ttl())
+
+    def most_cited(self, query: str, k: int = 3) -> List[Article]:
+        """
+        Returns the k most cited articles ever recorded for the query, with
+        the best known citation counts. Counts of the returned articles that
+        are still unknown, typically of arxiv results, are fetched for the
+        next rerun.
+        """
+        seen = _query_cache.get(_normalize(query)) or {}
+        articles = []
+        unknown = set()
+        for obj in seen.values():
+            article = Article.from_json(obj)
+            cached = _citation_cache.get(article_key(article))
+            if cached is None and not article.num_citations:
+                unknown.add(article_key(article))
+            article.num_citations = max(article.num_citations, cached or 0)
+            articles.append(article)
+        top = sorted(articles, key=lambda a: a.num_citations, reverse=True)[:k]
+        for article in top:
+            if article_key(article) in unknown:
+                self._submit(f"citations:{article_key(article)}", self._fetch_citations, article.title)
+        return top
+
+    def _submit(self, task_key: str, fn, *args) -> None:
+        if task_key in _failed_lookups:
+            return
+        with self._lock:
+            if task_key in self._in_flight or len(self._in_flight) >= _max_queued():
+                # a rerun asks again once the queue has room
+                return
+            self._in_flight.add(task_key)
+        future = _lookup_executor.submit(self._lookup, task_key, fn, *args)
+        future.add_done_callback(lambda _: self._done(task_key))
+
+    def _lookup(self, task_key: str, fn, *args) -> None:
+        _pace()
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.warning(f"scholar lookup {task_key} failed: {e}")
+            _failed_lookups.set(task_key, str(e), ttl=_failure_ttl())
+
+    def _done(self, task_key: str) -> None:
+        with self._lock:
+            self._in_flight.discard(task_key)
+
+    def _fetch_author(self, author_id: str) -> None:
+        author = scholarly.fill(scholarly.search_author_id(author_id),
+                                sections=["basics", "indices"])
+        _author_cache.set(author_id, {
+            "name": author.get("name", ""),
+            "affiliation": author.get("affiliation", ""),
+            "citedby": author.get("citedby", 0),
+            "hindex": author.get("hindex", 0),
+            "interests": author.get("interests", []),
+        }, ttl=_author_ttl())
+
+    def _fetch_citations(self, title: str) -> None:
+        pub = scholarly.search_single_pub(title)
+        key = _normalize(title)
+        # the closest match may be another paper. Misses are cached too, so
+        # unknown papers are not looked up again
+        num_citations = 0
+        if pub and _normalize(pub.get("bib", {}).get("title", "")) == key:
+            num_citations = pub.get("num_citations", 0)
+        _citation_cache.set(key, num_citations, ttl=_citation_ttl())
+
+
+citation_cache = CitationCache()
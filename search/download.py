@@ -0,0 +1,117 @@
+import os
+import re
+import threading
+from concurrent.futures import Future
+from typing import List
+
+import requests
+import streamlit as st
+from loguru import logger
+
+from structs import Article
+
+PDF_DIR = "arxiv_pdf"
+
+
+def pdf_path(article: Article, pdf_dir: str = PDF_DIR) -> str:
+    return os.path.join(pdf_dir, article.id + '.pdf')
+
+
+class PaperDownloader(object):
+    """
+    Downloads paper pdfs into the shared on-disk paper store.
+
+    Downloads stream into a `.part` file which is renamed into place only
+    once complete, so a failed download never leaves a corrupt pdf behind.
+    An interrupted `.part` file is resumed with an HTTP range request. The
+    ARXIV_DOWNLOAD_URL mirror is tried first, falling back to the original
+    url. Concurrent downloads of the same paper, from any session, share one
+    transfer.
+    """
+
+    def __init__(self, pdf_dir: str = PDF_DIR, timeout: tuple[float, float] = (10, 60), chunk_size: int = 1 << 16) -> None:
+        self.pdf_dir = pdf_dir
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._session = requests.Session()
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def download(self, article: Article) -> str:
+        """
+        Returns the local path of the article's pdf, downloading it if needed.
+        """
+        filename = pdf_path(article, self.pdf_dir)
+        if os.path.exists(filename):
+            return filename
+        with self._lock:
+            future = self._inflight.get(filename)
+            owner = future is None
+            if owner:
+                future = self._inflight[filename] = Future()
+        if not owner:
+            logger.info(f"waiting for running download... {filename}")
+            return future.result()
+        try:
+            self._download(article.pdf_url, filename)
+            future.set_result(filename)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[filename]
+        return filename
+
+    def _candidate_urls(self, pdf_url: str) -> List[str]:
+        url = pdf_url.replace("html", "pdf")
+        urls = []
+        if mirror_url := st.secrets.get("ARXIV_DOWNLOAD_URL", ""):
+            mirrored = re.sub(r"^https?://arxiv\.org", mirror_url.rstrip("/"), url)
+            if mirrored != url:
+                urls.append(mirrored)
+        urls.append(url)
+        return urls
+
+    def _download(self, pdf_url: str, filename: str) -> None:
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        part = filename + ".part"
+        error = None
+        for url in self._candidate_urls(pdf_url):
+            try:
+                logger.info(f"downloading pdf... {url} -> {filename}")
+                self._fetch(url, part)
+                with open(part, "rb") as f:
+                    magic = f.read(5)
+                if magic != b"%PDF-":
+                    # e.g. a captcha or error page served with status 200
+                    os.remove(part)
+                    raise ValueError(f"{url} did not return a pdf")
+                os.replace(part, filename)
+                return
+            except (requests.RequestException, ValueError) as e:
+                logger.warning(f"failed to download {url}: {e}")
+                error = e
+        raise error
+
+    def _fetch(self, url: str, part: str) -> None:
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self._session.get(url, headers=headers, stream=True,
+                               timeout=self.timeout, allow_redirects=True) as r:
+            if r.status_code == 416:
+                # the partial file does not match the remote one, start over
+                os.remove(part)
+                return self._fetch(url, part)
+            r.raise_for_status()
+            mode = "ab" if offset and r.status_code == 206 else "wb"
+            with open(part, mode) as f:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+
+
+downloader = PaperDownloader()
+
+
+def download_pdf(article: Article) -> str:
+    return downloader.download(article)
@@ -0,0 +1,194 @@
+import os
+import queue
+import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, List
+
+import streamlit as st
+from loguru import logger
+
+from search.arxiv import ArxivSearch
+from search.citations import citation_cache
+from search.download import download_pdf
+from search.gscholar import GoogleScholarSearch
+from search.local_arxiv import LocalArxivIndex, LocalArxivSearch
+from search.pdf import extract_document, extract_text
+from structs import Article, PaperDocument
+
+_arxiv_id_pattern = re.compile(
+    r"arxiv\.org/(?:abs|pdf)/([a-z\-]+(?:\.[A-Z]{2})?/\d{7}|\d{4}\.\d{4,5})", re.IGNORECASE)
+_doi_pattern = re.compile(r"\b(10\.\d{4,9}/[^\s\"<>]+)")
+_non_word_pattern = re.compile(r"\W+")
+
+# shared by all sessions, one slot per backend call in flight
+_executor = ThreadPoolExecutor(8, thread_name_prefix="federated-search")
+
+
+def dedupe_keys(article: Article) -> List[str]:
+    keys = []
+    for value in (article.url, article.pdf_url):
+        if match := _arxiv_id_pattern.search(value):
+            keys.append(f"arxiv:{match.group(1).lower()}")
+            break
+    for value in (article.url, article.journal_ref, article.comment):
+        if match := _doi_pattern.search(value):
+            keys.append(f"doi:{match.group(1).lower().rstrip('.')}")
+            break
+    if title := _non_word_pattern.sub(' ', article.title.lower()).strip():
+        keys.append(f"title:{title}")
+    return keys
+
+
+_local_index: LocalArxivIndex = None
+_local_index_lock = threading.Lock()
+
+
+def _stream(backend, partial: queue.SimpleQueue, *args) -> List[Article]:
+    # articles go out one by one as the backend parses them, the future
+    # itself only signals completion
+    for article in backend.stream_search(*args):
+        partial.put(article)
+    return []
+
+
+def local_arxiv_search() -> LocalArxivSearch:
+    """
+    Returns a searcher over the local arxiv index when ARXIV_LOCAL_INDEX
+    points to one, the index is opened once per process.
+    """
+    global _local_index
+    path = st.secrets.get("ARXIV_LOCAL_INDEX", "")
+    if not path or not os.path.exists(path):
+        return None
+    with _local_index_lock:
+        if _local_index is None or _local_index.path != path:
+            _local_index = LocalArxivIndex(path)
+    return LocalArxivSearch(_local_index)
+
+
+class FederatedQuery(object):
+    """
+    One search fanned out to several backends. Results are merged and
+    de-duplicated as each backend answers.
+    """
+
+    def __init__(self, futures: Dict[Future, str], seen: Dict[str, Article],
+                 partial: queue.SimpleQueue = None, query: str = "") -> None:
+        self.query = query
+        self._futures = futures
+        self._seen = seen
+        self._partial = partial or queue.SimpleQueue()
+
+    @property
+    def done(self) -> bool:
+        return not self._futures and self._partial.empty()
+
+    def _drain(self) -> List[Article]:
+        results = []
+        while True:
+            try:
+                results.append(self._partial.get_nowait())
+            except queue.Empty:
+                return self._merge(results)
+
+    def poll(self, timeout: float = None) -> List[Article]:
+        """
+        Waits up to timeout for at least one more backend and returns the
+        new unique articles of the backends that answered. Articles of
+        streaming backends are returned as soon as they are parsed.
+        """
+        if articles := self._drain():
+            return articles
+        if not self._futures:
+            return []
+        done, _ = wait(self._futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        articles = self._drain()
+        for future in done:
+            backend = self._futures.pop(future)
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.error(f"{backend} search failed: {e}")
+                continue
+            logger.info(f"{backend} answered")
+            articles += self._merge(results)
+        return articles + self._drain()
+
+    def result(self) -> List[Article]:
+        articles = []
+        while not self.done:
+            articles += self.poll()
+        return articles
+
+    def _merge(self, results: List[Article]) -> List[Article]:
+        new = []
+        merged = []
+        for article in results:
+            keys = dedupe_keys(article)
+            if existing := next((self._seen[k] for k in keys if k in self._seen), None):
+                # keep the first copy, enriched with what the other backend knows
+                existing.num_citations = max(existing.num_citations, article.num_citations)
+                if 'arxiv.org' not in existing.url and 'arxiv.org' in article.url:
+                    existing.id = article.id
+                    existing.url = article.url
+                    existing.pdf_url = article.pdf_url
+                article = existing
+            else:
+                new.append(article)
+            merged.append(article)
+            for k in keys:
+                self._seen.setdefault(k, article)
+        if self.query and merged:
+            # off the rerun, it touches the disk
+            _executor.submit(citation_cache.record, self.query, merged)
+        return new
+
+
+class FederatedSearch(object):
+    """
+    Queries arXiv and Google Scholar concurrently. Offers the same
+    search/more/download interface as the single backends, plus submit() to
+    consume results as each backend answers.
+    """
+
+    def __init__(self, backends: Dict[str, object] = None) -> None:
+        self.backends = backends or {
+            "arxiv": local_arxiv_search() or ArxivSearch(),
+            "scholar": GoogleScholarSearch(),
+        }
+        self._seen: Dict[str, Article] = {}
+        self._backends_in_use: List[str] = []
+        self.last_content = ""  # query of the last submit
+
+    def submit(self, content: str, year_from: int = None, sort_by: str = "relevance", backends: List[str] = None) -> FederatedQuery:
+        self._backends_in_use = backends or list(self.backends)
+        self._seen = {}
+        self.last_content = content
+        partial = queue.SimpleQueue()
+        futures = {}
+        for name in self._backends_in_use:
+            backend = self.backends[name]
+            if hasattr(backend, "stream_search"):
+                future = _executor.submit(_stream, backend, partial, content, year_from, sort_by)
+            else:
+                future = _executor.submit(backend.search, content, year_from, sort_by)
+            futures[future] = name
+        return FederatedQuery(futures, self._seen, partial, content)
+
+    def search(self, content: str, year_from: int = None, sort_by: str = "relevance", backends: List[str] = None) -> List[Article]:
+        return self.submit(content, year_from, sort_by, backends).result()
+
+    def more(self, length: int = 10) -> List[Article]:
+        futures = {
+            _executor.submit(self.backends[name].more, length): name
+            for name in self._backends_in_use
+            if hasattr(self.backends[name], "more")
+        }
+        return FederatedQuery(futures, self._seen, query=self.last_content).result()
+
+    def download_and_read(self, article: Article) -> str:
+        return extract_text(download_pdf(article))
+
+    def download_and_parse(self, article: Article) -> PaperDocument:
+        return extract_document(download_pdf(article))
@@ -1,91 +1,161 @@
-import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 
-import fitz
-import requests
 import streamlit as st
 from loguru import logger
 from scholarly import scholarly
 
+from cache import DiskCache, make_key
+from search.download import download_pdf
+from search.pdf import extract_document, extract_text
+from structs import Article, Author, PaperDocument
 
-class GoogleScholarSearch(object):
-    def __init__(self) -> None:
-        self.last_query = None
 
-    def search(self, content: str, year_from: int = None, sort_by: str = "relevance"):
-        query_str = f"{content}"
-        query = scholarly.search_pubs(
-            query_str, year_low=year_from, sort_by=sort_by)
-        self.last_query = query
-        articles = []
-        for _ in range(10):
+PAGE_SIZE = 10
+# live scholar results per query are capped to avoid being blocked by google
+MAX_RECORDS = 30
+
+# result pages by (query, year_from, sort_by, page), shared by all sessions
+_search_cache = DiskCache("gscholar_search")
+
+
+def _cache_ttl() -> float:
+    return float(st.secrets.get("GSCHOLAR_CACHE_TTL", 24 * 3600))
+
+
+# background workers fetching the next result page ahead of "More" clicks
+_prefetch_executor = ThreadPoolExecutor(4, thread_name_prefix="gscholar-prefetch")
+
+
+class _ScholarQuery(object):
+    """
+    Result pages of one search. Pages come from the shared cache, from memory
+    once fetched, or from a live scholarly iterator.
+    """
+
+    def __init__(self, content: str, year_from: int, sort_by: str, build_article: Callable) -> None:
+        self.content = content
+        self.year_from = year_from
+        self.sort_by = sort_by
+        self.cancelled = threading.Event()
+        self._build_article = build_article
+        self._pages: dict[int, list] = {}
+        self._iterator = None  # live scholarly iterator, if one was needed
+        self._live_index = 0  # index of the record _iterator yields next
+        self._lock = threading.Lock()
+        # kept here rather than on the searcher, so a replaced query still
+        # finishing in another thread cannot move the new one
+        self.offset = 0  # records handed out
+        self.exhausted = False  # no more results
+
+    def page(self, page_index: int):
+        """
+        Returns the page, or None if the query was cancelled meanwhile.
+        """
+        with self._lock:
+            if (page := self._pages.get(page_index)) is not None:
+                return page
+            cache_key = make_key(self.content, self.year_from, self.sort_by, page_index)
+            if (cached := _search_cache.get(cache_key)) is not None:
+                page = [Article.from_json(a) for a in cached]
+            else:
+                page = self._fetch(page_index)
+                if page is None:
+                    return None
+                _search_cache.set(cache_key, [a.to_json() for a in page], ttl=_cache_ttl())
+            self._pages[page_index] = page
+            return page
+
+    def _fetch(self, page_index: int):
+        start = page_index * PAGE_SIZE
+        if self._iterator is None or self._live_index != start:
+            logger.info(f"scholar query: {self.content}, from {start}")
+            self._iterator = scholarly.search_pubs(
+                self.content, year_low=self.year_from, sort_by=self.sort_by,
+                start_index=start)
+            self._live_index = start
+        page = []
+        for _ in range(PAGE_SIZE):
+            if self.cancelled.is_set():
+                return None
             try:
-                r = next(query)
-                article = self._build_article(r)
-                articles.append(article)
+                r = next(self._iterator)
             except StopIteration as e:
                 break
+            self._live_index += 1
+            page.append(self._build_article(r))
+        return page
+
+
+class GoogleScholarSearch(object):
+    def __init__(self) -> None:
+        self.last_query: _ScholarQuery = None
+
+    def search(self, content: str, year_from: int = None, sort_by: str = "relevance"):
+        if self.last_query:
+            # stop prefetching for the query being replaced
+            self.last_query.cancelled.set()
+        query = self.last_query = _ScholarQuery(
+            f"{content}", year_from, sort_by, self._build_article)
+        articles = self._take(query, PAGE_SIZE)
+        self._prefetch(query)
         return articles
 
     def more(self, length: int = 10):
-        if not self.last_query or length >= 30:
+        query = self.last_query
+        if not query or length >= MAX_RECORDS:
             logger.warning(f"no last_query or too large length")
             return []
+        articles = self._take(query, length)
+        self._prefetch(query)
+        return articles
+
+    @staticmethod
+    def _take(query: _ScholarQuery, length: int):
         articles = []
-        for _ in range(length):
-            try:
-                r = next(self.last_query)
-                article = self._build_article(r)
-                articles.append(article)
-            except StopIteration as e:
+        while len(articles) < length:
+            page_index, skip = divmod(query.offset, PAGE_SIZE)
+            page = query.page(page_index)
+            if page is None:
+                # cancelled, which says nothing about the results left
+                break
+            if len(page) < PAGE_SIZE:
+                query.exhausted = True
+            page = page[skip:skip + length - len(articles)]
+            if not page:
                 break
+            articles += page
+            query.offset += len(page)
         return articles
 
-    def _build_article(self, r):
-        authors = []
-        for i, name in enumerate(r['bib']['author']):
-            author_id = r['author_id'][i]
-            authors.append({
-                'name': name,
-                'id': author_id,
-                'citation_url': f"https://scholar.google.com/citations?user={author_id}"
-            })
-        article = {
-            'id': r['pub_url'].split('/abs/')[-1],
-            'term': '',
-            'terms': '',
-            'main_author': r['bib']['author'][0],
-            'authors': authors,
-            'url': r['pub_url'],
-            'pdf_url': r.get('eprint_url', r['pub_url'].replace('abs', 'pdf')),
-            'title': r['bib']['title'],
-            'abstract': r['bib']['abstract'],
-            'update_date': '',
-            'publish_date': r['bib']['pub_year'],
-            'comment': '',
-            'journal_ref': r['bib']['venue'],
-            'num_citations': r['num_citations']
-        }
-        return article
-
-    def download_and_read(self, article: dict) -> str:
-        pdf_dir = "arxiv_pdf"
-        if not os.path.isdir(pdf_dir):
-            os.mkdir(pdf_dir)
-        filename = f"{pdf_dir}/{article['id'] + '.pdf'}"
-        logger.info(f"downloading arxiv pdf... {filename}")
-        if not os.path.exists(filename):
-            pdf_url = article['pdf_url']
-            if mirror_url := st.secrets.get("ARXIV_DOWNLOAD_URL", ""):
-                pdf_url = article['pdf_url'].replace(
-                    "https://arxiv.org", mirror_url)
-            r = requests.get(article['pdf_url'].replace(
-                "html", "pdf"), allow_redirects=True)
-            with open(filename, "wb") as f:
-                f.write(r.content)
-        text = ""
-        logger.info(f"reading pdf...")
-        with fitz.open(filename) as doc:
-            for page in doc:
-                text += page.get_text()
-        logger.info(f"reading pdf...done")
-        return text
+    @staticmethod
+    def _prefetch(query: _ScholarQuery) -> None:
+        """
+        Fetches the first page not handed out yet in the background, so the
+        next more() is served from memory. A more() racing the prefetch
+        waits for it on the page lock instead of querying twice.
+        """
+        next_index = -(-query.offset // PAGE_SIZE)
+        if query.exhausted or query.cancelled.is_set() or next_index * PAGE_SIZE >= MAX_RECORDS:
+            return
+        _prefetch_executor.submit(query.page, next_index)
+
+    def _build_article(self, r) -> Article:
+        return Article(
+            id=r['pub_url'].split('/abs/')[-1],
+            authors=[Author(name=name, id=author_id)
+                     for name, author_id in zip(r['bib']['author'], r['author_id'])],
+            url=r['pub_url'],
+            pdf_url=r.get('eprint_url', r['pub_url'].replace('abs', 'pdf')),
+            title=r['bib']['title'],
+            abstract=r['bib']['abstract'],
+            publish_date=r['bib']['pub_year'],
+            journal_ref=r['bib']['venue'],
+            num_citations=r['num_citations'])
+
+    def download_and_read(self, article: Article) -> str:
+        return extract_text(download_pdf(article))
+
+    def download_and_parse(self, article: Article) -> PaperDocument:
+        return extract_document(download_pdf(article))
@@ -0,0 +1,356 @@
+"""
+An optional local arXiv metadata index for offline, millisecond search.
+
+The index is a sqlite database with an FTS5 inverted index over titles,
+abstracts, authors and categories. It is built from the public metadata
+snapshot (one JSON object per line, as published on Kaggle) and kept up to
+date by incremental OAI-PMH harvests, which upsert changed records instead
+of rebuilding.
+
+    python -m search.local_arxiv --db arxiv_index.sqlite snapshot arxiv-metadata-oai-snapshot.json
+    python -m search.local_arxiv --db arxiv_index.sqlite harvest
+"""
+
+import argparse
+import json
+import re
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import date, datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import Iterable, Iterator, List
+
+import requests
+from loguru import logger
+
+from search.download import download_pdf
+from search.pdf import extract_document, extract_text
+from structs import Article, Author, PaperDocument
+
+OAI_URL = "https://export.arxiv.org/oai2"
+_oai = "{http://www.openarchives.org/OAI/2.0/}"
+_arxiv = "{http://arxiv.org/OAI/arXiv/}"
+_field_columns = {"ti": "title", "abs": "abstract", "au": "authors", "cat": "categories"}
+_term_pattern = re.compile(r"(?:(ti|abs|au|cat|all):)?(\"[^\"]+\"|\S+)")
+
+_schema = """
+CREATE TABLE IF NOT EXISTS papers (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    abstract TEXT,
+    authors TEXT,
+    categories TEXT,
+    comments TEXT,
+    journal_ref TEXT,
+    doi TEXT,
+    published TEXT,
+    updated TEXT
+);
+CREATE INDEX IF NOT EXISTS papers_published ON papers(published);
+CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(
+    title, abstract, authors, categories,
+    content='papers', content_rowid='rowid', tokenize='porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS papers_ai AFTER INSERT ON papers BEGIN
+    INSERT INTO papers_fts(rowid, title, abstract, authors, categories)
+    VALUES (new.rowid, new.title, new.abstract, new.authors, new.categories);
+END;
+CREATE TRIGGER IF NOT EXISTS papers_ad AFTER DELETE ON papers BEGIN
+    INSERT INTO papers_fts(papers_fts, rowid, title, abstract, authors, categories)
+    VALUES ('delete', old.rowid, old.title, old.abstract, old.authors, old.categories);
+END;
+CREATE TRIGGER IF NOT EXISTS papers_au AFTER UPDATE ON papers BEGIN
+    INSERT INTO papers_fts(papers_fts, rowid, title, abstract, authors, categories)
+    VALUES ('delete', old.rowid, old.title, old.abstract, old.authors, old.categories);
+    INSERT INTO papers_fts(rowid, title, abstract, authors, categories)
+    VALUES (new.rowid, new.title, new.abstract, new.authors, new.categories);
+END;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+_upsert = """
+INSERT INTO papers (id, title, abstract, authors, categories, comments, journal_ref, doi, published, updated)
+VALUES (:id, :title, :abstract, :authors, :categories, :comments, :journal_ref, :doi, :published, :updated)
+ON CONFLICT(id) DO UPDATE SET
+    title=excluded.title, abstract=excluded.abstract, authors=excluded.authors,
+    categories=excluded.categories, comments=excluded.comments,
+    journal_ref=excluded.journal_ref, doi=excluded.doi,
+    published=excluded.published, updated=excluded.updated
+"""
+
+
+def _clean(text: str) -> str:
+    return " ".join((text or "").split())
+
+
+class LocalArxivIndex(object):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(_schema)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections must stay on the thread that opened them
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            # readers keep going while a harvest writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def upsert(self, records: Iterable[dict], batch_size: int = 5000) -> int:
+        conn = self._connection()
+        count = 0
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                with conn:
+                    conn.executemany(_upsert, batch)
+                count += len(batch)
+                batch = []
+                logger.info(f"indexed {count} arxiv records...")
+        if batch:
+            with conn:
+                conn.executemany(_upsert, batch)
+            count += len(batch)
+        return count
+
+    def get_meta(self, key: str) -> str:
+        row = self._connection().execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def load_snapshot(self, filepath: str) -> int:
+        """
+        Loads the metadata snapshot, one JSON record per line.
+        """
+        def records():
+            with open(filepath, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield self._snapshot_record(json.loads(line))
+        count = self.upsert(records())
+        logger.info(f"loaded {count} arxiv records from {filepath}")
+        return count
+
+    @staticmethod
+    def _snapshot_record(obj: dict) -> dict:
+        # "authors" reads "A, B and C", the parsed [keyname, forenames,
+        # suffix] triples give the same names as an OAI record
+        authors = [_clean(" ".join(filter(None, [forenames, keyname])))
+                   for keyname, forenames, *_ in obj.get("authors_parsed") or []]
+        versions = obj.get("versions") or []
+        published = ""
+        if versions and versions[0].get("created"):
+            published = parsedate_to_datetime(versions[0]["created"]).strftime("%Y-%m-%d")
+        return {
+            "id": obj["id"],
+            "title": _clean(obj.get("title")),
+            "abstract": _clean(obj.get("abstract")),
+            "authors": ", ".join(authors) or _clean(obj.get("authors")),
+            "categories": obj.get("categories") or "",
+            "comments": _clean(obj.get("comments")),
+            "journal_ref": _clean(obj.get("journal-ref")),
+            "doi": obj.get("doi") or "",
+            "published": published,
+            "updated": obj.get("update_date") or published,
+        }
+
+    def harvest(self, from_date: date = None) -> int:
+        """
+        Upserts the records changed since from_date, by default since the
+        last harvest, via OAI-PMH. Run it daily to keep the index current.
+        """
+        if from_date is None and (last := self.get_meta("last_harvest")):
+            from_date = date.fromisoformat(last)
+        started = datetime.now(timezone.utc).date()
+        count = self.upsert(self._harvest_records(from_date))
+        # overlap by a day, OAI datestamps are not exact to the hour
+        self.set_meta("last_harvest", (started - timedelta(days=1)).isoformat())
+        logger.info(f"harvested {count} arxiv records since {from_date}")
+        return count
+
+    def _harvest_records(self, from_date: date = None) -> Iterator[dict]:
+        session = requests.Session()
+        params = {"verb": "ListRecords", "metadataPrefix": "arXiv"}
+        if from_date:
+            params["from"] = from_date.isoformat()
+        while True:
+            response = session.get(OAI_URL, params=params, timeout=120)
+            if response.status_code == 503:
+                # the OAI endpoint paces harvesters with Retry-After
+                delay = int(response.headers.get("Retry-After", 10))
+                logger.info(f"arxiv oai asked to retry after {delay}s")
+                time.sleep(delay)
+                continue
+            response.raise_for_status()
+            root = ET.fromstring(response.content)
+            for record in root.iter(f"{_oai}record"):
+                if (metadata := record.find(f"{_oai}metadata/{_arxiv}arXiv")) is not None:
+                    yield self._oai_record(metadata)
+            token = root.find(f"{_oai}ListRecords/{_oai}resumptionToken")
+            if token is None or not (token.text or "").strip():
+                return
+            params = {"verb": "ListRecords", "resumptionToken": token.text.strip()}
+
+    @staticmethod
+    def _oai_record(metadata: ET.Element) -> dict:
+        def text(tag):
+            return _clean(metadata.findtext(f"{_arxiv}{tag}"))
+        authors = []
+        for author in metadata.iter(f"{_arxiv}author"):
+            name = " ".join(filter(None, [author.findtext(f"{_arxiv}forenames"),
+                                          author.findtext(f"{_arxiv}keyname")]))
+            authors.append(_clean(name))
+        published = text("created")
+        return {
+            "id": text("id"),
+            "title": text("title"),
+            "abstract": text("abstract"),
+            "authors": ", ".join(authors),
+            "categories": text("categories"),
+            "comments": text("comments"),
+            "journal_ref": text("journal-ref"),
+            "doi": text("doi"),
+            "published": published,
+            "updated": text("updated") or published,
+        }
+
+    def query(self, content: str, date_from: date = None, sort_by: str = "relevance",
+              start: int = 0, max_results: int = 10) -> List[sqlite3.Row]:
+        match = self._match_expression(content)
+        if not match:
+            return []
+        sql = "SELECT papers.* FROM papers_fts JOIN papers ON papers.rowid = papers_fts.rowid WHERE papers_fts MATCH ?"
+        args: list = [match]
+        if date_from:
+            sql += " AND papers.published >= ?"
+            args.append(date_from.isoformat())
+        if sort_by == "date":
+            sql += " ORDER BY papers.published DESC"
+        else:
+            # title matches weigh the most, then authors, abstract, categories
+            sql += " ORDER BY bm25(papers_fts, 10.0, 1.0, 3.0, 0.5)"
+        sql += " LIMIT ? OFFSET ?"
+        args += [max_results, start]
+        return self._connection().execute(sql, args).fetchall()
+
+    @staticmethod
+    def _match_expression(content: str) -> str:
+        """
+        Turns a query like `ti:attention au:vaswani "machine translation"`
+        into an FTS5 expression, quoting every term so user input can not
+        inject FTS syntax.
+        """
+        clauses = []
+        for field, term in _term_pattern.findall(content):
+            term = term.strip('"').replace('"', '""')
+            if not term.strip():
+                continue
+            clause = f'"{term}"'
+            if field in _field_columns:
+                clause = f"{_field_columns[field]} : {clause}"
+            clauses.append(clause)
+        return " AND ".join(clauses)
+
+
+class _LocalQuery(object):
+    """
+    Arguments of one search and the rows handed out so far. A replaced query
+    finishing late in another thread only moves its own offset.
+    """
+
+    def __init__(self, args: tuple, offset: int = 0) -> None:
+        self.args = args
+        self.offset = offset
+
+
+class LocalArxivSearch(object):
+    """
+    Searches a LocalArxivIndex, returning the same Article records as
+    ArxivSearch.
+    """
+
+    def __init__(self, index: LocalArxivIndex) -> None:
+        self.index = index
+        self._last_query: _LocalQuery = None
+
+    def search(self, content: str | List[str], year_from: int = None, sort_by: str = "relevance",
+               start: int = 0, max_results: int = 10):
+        if isinstance(content, list):
+            content = " ".join(content)
+        date_from = date(year_from, 1, 1) if year_from else None
+        query = self._last_query = _LocalQuery((content, date_from, sort_by), start)
+        rows = self.index.query(*query.args, start, max_results)
+        query.offset += len(rows)
+        return [self._build_article(row) for row in rows]
+
+    def more(self, length: int = 10):
+        query = self._last_query
+        if not query:
+            logger.warning(f"no last query")
+            return []
+        rows = self.index.query(*query.args, start=query.offset, max_results=length)
+        query.offset += len(rows)
+        return [self._build_article(row) for row in rows]
+
+    @staticmethod
+    def _parse_date(value: str) -> datetime:
+        try:
+            return datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+
+    def _build_article(self, row: sqlite3.Row) -> Article:
+        categories = (row["categories"] or "").split()
+        return Article(
+            id=row["id"],
+            term=categories[0] if categories else '',
+            terms='|'.join(categories),
+            authors=[Author(name=name) for name in (row["authors"] or "").split(",") if name.strip()],
+            url=f"http://arxiv.org/abs/{row['id']}",
+            pdf_url=f"http://arxiv.org/pdf/{row['id']}",
+            title=row["title"],
+            abstract=row["abstract"],
+            update_date=self._parse_date(row["updated"]),
+            publish_date=self._parse_date(row["published"]),
+            comment=row["comments"] or 'No comment found',
+            journal_ref=row["journal_ref"] or 'No journal ref found')
+
+    def download_and_read(self, article: Article) -> str:
+        return extract_text(download_pdf(article))
+
+    def download_and_parse(self, article: Article) -> PaperDocument:
+        return extract_document(download_pdf(article))
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="build or update the local arxiv index")
+    arg_parser.add_argument("--db", default="arxiv_index.sqlite")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    snapshot = commands.add_parser("snapshot", help="load a metadata snapshot json file")
+    snapshot.add_argument("path")
+    harvest = commands.add_parser("harvest", help="harvest changes since the last harvest")
+    harvest.add_argument("--from-date", type=date.fromisoformat, default=None)
+    query = commands.add_parser("search", help="run a query against the index")
+    query.add_argument("query")
+    args = arg_parser.parse_args()
+
+    index = LocalArxivIndex(args.db)
+    if args.command == "snapshot":
+        index.load_snapshot(args.path)
+    elif args.command == "harvest":
+        index.harvest(args.from_date)
+    else:
+        for article in LocalArxivSearch(index).search(args.query):
+            print(article.id, article.title)
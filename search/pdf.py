@@ -0,0 +1,243 @@
+import json
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Tuple
+
+import fitz
+from loguru import logger
+
+from cache import file_digest
+from search.download import PDF_DIR
+from structs import PaperCaption, PaperDocument, PaperPage, PaperSection
+
+# bump whenever the extracted output changes, stale documents are ignored
+EXTRACTOR_VERSION = 2
+# smaller documents are not worth the inter-process round trip
+PARALLEL_MIN_PAGES = 32
+PAGES_PER_TASK = 16
+
+_pool: ProcessPoolExecutor = None
+_pool_lock = threading.Lock()
+
+
+def _process_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # the streamlit server is multi-threaded, never fork it
+            _pool = ProcessPoolExecutor(
+                max_workers=min(4, os.cpu_count() or 1),
+                mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _reset_process_pool() -> None:
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+
+def _extract_pages(filename: str, start: int, stop: int) -> List[str]:
+    # every worker opens its own document, fitz documents are not shareable
+    with fitz.open(filename) as doc:
+        return [doc[i].get_text() for i in range(start, stop)]
+
+
+def _extract_all_pages(filename: str) -> Tuple[List[str], List[list]]:
+    with fitz.open(filename) as doc:
+        page_count = doc.page_count
+        toc = doc.get_toc()
+    if page_count < PARALLEL_MIN_PAGES:
+        return _extract_pages(filename, 0, page_count), toc
+    ranges = [(start, min(start + PAGES_PER_TASK, page_count))
+              for start in range(0, page_count, PAGES_PER_TASK)]
+    try:
+        pool = _process_pool()
+        futures = [pool.submit(_extract_pages, filename, start, stop)
+                   for start, stop in ranges]
+        return [page for future in futures for page in future.result()], toc
+    except BrokenProcessPool as e:
+        logger.warning(f"pdf extraction pool is broken, reading in process: {e}")
+        _reset_process_pool()
+        return _extract_pages(filename, 0, page_count), toc
+
+
+_heading_pattern = re.compile(
+    r"^(?:(?P<number>\d+(?:\.\d+)*)\.?\s+(?P<title>[A-Z][^\n]{2,80})"
+    r"|(?P<named>Abstract|Introduction|Related Work|Background|Conclusions?"
+    r"|Discussion|Acknowledge?ments?|References|Bibliography|Appendix"
+    r"(?: [A-Z])?))\s*$",
+    re.MULTILINE)
+_caption_pattern = re.compile(
+    r"^(?P<label>(?:Figure|Fig\.|Table)\s*\d+)\s*[.:]\s*(?P<caption>\S[^\n]*(?:\n[^\n]+){0,2})",
+    re.MULTILINE)
+_reference_split_pattern = re.compile(r"\n(?=\[\d+\]\s)")
+_reference_titles = ("references", "bibliography")
+
+
+def _find_title(text: str, title: str, start: int, end: int) -> int:
+    words = re.findall(r"\w+", title)
+    if not words:
+        return -1
+    pattern = r"\W+".join(re.escape(w) for w in words)
+    match = re.compile(pattern, re.IGNORECASE).search(text, start, end)
+    return match.start() if match else -1
+
+
+def _parse_sections(text: str, pages: List[PaperPage], toc: List[list]) -> List[PaperSection]:
+    sections = []
+    if toc:
+        # the outline embedded in the pdf is the most reliable source
+        for level, title, page_number in toc:
+            if not 1 <= page_number <= len(pages):
+                continue
+            page = pages[page_number - 1]
+            start = _find_title(text, title, page.start, page.end)
+            sections.append(PaperSection(
+                title=title.strip(), level=level, page=page_number,
+                start=start if start >= 0 else page.start))
+    else:
+        for match in _heading_pattern.finditer(text):
+            number = match.group("number")
+            title = match.group("title") or match.group("named")
+            # skip numbered lines that look like sentences or table rows
+            if number and (title.endswith(".") or len(title.split()) > 12):
+                continue
+            level = number.count(".") + 1 if number else 1
+            sections.append(PaperSection(
+                title=match.group(0).strip(), level=level, start=match.start()))
+        for section in sections:
+            section.page = _page_number_at(pages, section.start)
+    sections.sort(key=lambda s: s.start)
+    for i, section in enumerate(sections):
+        # a section ends where the next section of the same or a higher level starts
+        section.end = next((s.start for s in sections[i + 1:]
+                            if s.level <= section.level), len(text))
+    return sections
+
+
+def _page_number_at(pages: List[PaperPage], offset: int) -> int:
+    for page in pages:
+        if page.start <= offset < page.end:
+            return page.number
+    return pages[-1].number if pages else 0
+
+
+def _parse_captions(text: str, pages: List[PaperPage]) -> List[PaperCaption]:
+    captions = []
+    seen = set()
+    for match in _caption_pattern.finditer(text):
+        label = match.group("label")
+        if label in seen:
+            # later hits are usually in-text references like "Figure 2: shows"
+            continue
+        seen.add(label)
+        caption = " ".join(match.group("caption").split())
+        captions.append(PaperCaption(
+            label=label, caption=caption[:500],
+            page=_page_number_at(pages, match.start()), start=match.start()))
+    return captions
+
+
+def _parse_references(text: str, sections: List[PaperSection]) -> List[str]:
+    section = next((s for s in reversed(sections)
+                    if s.title.lower().lstrip("0123456789. ") in _reference_titles), None)
+    if section is None:
+        return []
+    body = text[section.start:section.end].split("\n", 1)[-1].strip()
+    if _reference_split_pattern.search(body):
+        entries = _reference_split_pattern.split(body)
+    else:
+        entries = re.split(r"\n\s*\n", body)
+    return [" ".join(e.split()) for e in entries if e.strip()]
+
+
+def build_document(doc_id: str, page_texts: List[str], toc: List[list] = []) -> PaperDocument:
+    pages = []
+    offset = 0
+    for number, page_text in enumerate(page_texts, 1):
+        pages.append(PaperPage(number=number, start=offset, text=page_text))
+        offset += len(page_text)
+    text = "".join(page_texts)
+    sections = _parse_sections(text, pages, toc)
+    return PaperDocument(
+        id=doc_id,
+        pages=pages,
+        sections=sections,
+        captions=_parse_captions(text, pages),
+        references=_parse_references(text, sections),
+    )
+
+
+class PaperStore(object):
+    """
+    Keeps parsed papers by id, as json files next to the pdfs. Recently used
+    documents stay in memory and are shared by all sessions.
+    """
+
+    def __init__(self, root: str = PDF_DIR, max_in_memory: int = 32) -> None:
+        self.root = root
+        self.max_in_memory = max_in_memory
+        self._documents: OrderedDict[str, PaperDocument] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, doc_id: str) -> str:
+        return os.path.join(self.root, f"{doc_id}.v{EXTRACTOR_VERSION}.json")
+
+    def _remember(self, doc: PaperDocument) -> None:
+        with self._lock:
+            self._documents[doc.id] = doc
+            self._documents.move_to_end(doc.id)
+            while len(self._documents) > self.max_in_memory:
+                self._documents.popitem(last=False)
+
+    def get(self, doc_id: str) -> PaperDocument:
+        with self._lock:
+            if doc := self._documents.get(doc_id):
+                self._documents.move_to_end(doc_id)
+                return doc
+        try:
+            with open(self._path(doc_id), "r", encoding="utf-8") as f:
+                doc = PaperDocument.from_json(json.load(f))
+        except (OSError, ValueError):
+            return None
+        self._remember(doc)
+        return doc
+
+    def put(self, doc: PaperDocument) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(doc.to_json(), f, ensure_ascii=False)
+        os.replace(tmp_path, self._path(doc.id))
+        self._remember(doc)
+
+
+paper_store = PaperStore()
+
+
+def extract_document(filename: str) -> PaperDocument:
+    """
+    Returns the parsed paper of a pdf. Documents are stored by the pdf's
+    content hash and the extractor version, so repeated opens of the same
+    paper are a single file read.
+    """
+    doc_id = file_digest(filename)
+    if doc := paper_store.get(doc_id):
+        return doc
+    logger.info(f"reading pdf... {filename}")
+    page_texts, toc = _extract_all_pages(filename)
+    doc = build_document(doc_id, page_texts, toc)
+    paper_store.put(doc)
+    logger.info(f"reading pdf...done, {len(doc.pages)} pages, {len(doc.sections)} sections")
+    return doc
+
+
+def extract_text(filename: str) -> str:
+    return extract_document(filename).text
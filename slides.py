@@ -60,7 +60,7 @@ class SlidesGenerator(object):
         title_shape.text = node.name
         body_shape = shapes.placeholders[1]
         tf = body_shape.text_frame
-        tf.text = f"By {', '.join([a['name'] for a in node.article['authors']])}, {node.article['publish_date']}"
+        tf.text = f"By {', '.join([a.name for a in node.article.authors])}, {node.article.publish_date}"
         summary_lines = node.chat_summary.split("\n")
         for line in summary_lines:
             p = tf.add_paragraph()
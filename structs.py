@@ -1,5 +1,8 @@
-from dataclasses import dataclass, field
-from typing import List, Any, Literal, Dict
+import sys
+from dataclasses import asdict, dataclass, field
+from datetime import date
+from typing import List, Any, Literal, Dict, Tuple
+from uuid import uuid4
 
 
 @dataclass
@@ -22,18 +25,232 @@ class ChatMessage(object):
             setattr(obj, k, v)
         return obj
 
+def _intern(value) -> str:
+    return sys.intern(str(value)) if value else ""
+
+
+def _date_str(value) -> str:
+    # datetimes and dates of the arxiv backends become YYYY-MM-DD, scholar
+    # only knows the year
+    if isinstance(value, date):
+        return sys.intern(value.strftime("%Y-%m-%d"))
+    return _intern(value)
+
+
+@dataclass(slots=True)
+class Author(object):
+    name: str = ""
+    id: str = ""  # google scholar author id, if known
+
+    def __post_init__(self) -> None:
+        # the same names show up in many results of many sessions
+        self.name = _intern(self.name.strip())
+        self.id = _intern(self.id)
+
+    @property
+    def citation_url(self) -> str:
+        return f"https://scholar.google.com/citations?user={self.id}" if self.id else ""
+
+    def to_json(self):
+        return {"name": self.name, "id": self.id} if self.id else {"name": self.name}
+
+    @classmethod
+    def from_json(cls, json_obj: Dict[str, Any] | str):
+        if isinstance(json_obj, str):
+            return cls(name=json_obj)
+        return cls(name=json_obj.get("name", ""), id=json_obj.get("id") or "")
+
+
+@dataclass(slots=True)
+class Article(object):
+    """
+    A search result of any backend. Kept per session in the result list and
+    on paper nodes, hence slotted and with repeated strings interned.
+    """
+    id: str = ""
+    title: str = ""
+    url: str = ""
+    pdf_url: str = ""
+    authors: Tuple[Author, ...] = ()
+    abstract: str = ""
+    publish_date: str = ""  # YYYY-MM-DD, or only the year
+    update_date: str = ""
+    journal_ref: str = ""
+    comment: str = ""
+    term: str = ""  # primary arxiv category
+    terms: str = ""  # all arxiv categories, "|" separated
+    num_citations: int = 0
+
+    def __post_init__(self) -> None:
+        self.authors = tuple(self.authors)
+        self.publish_date = _date_str(self.publish_date)
+        self.update_date = _date_str(self.update_date)
+        self.journal_ref = _intern(self.journal_ref)
+        self.comment = _intern(self.comment)
+        self.term = _intern(self.term)
+        self.terms = _intern(self.terms)
+        self.num_citations = int(self.num_citations or 0)
+
+    @property
+    def main_author(self) -> str:
+        return self.authors[0].name if self.authors else ""
+
+    def to_json(self):
+        json_obj = {}
+        for key in self.__dataclass_fields__.keys():
+            value = getattr(self, key)
+            if key == "authors":
+                value = [a.to_json() for a in value]
+            json_obj[key] = value
+        return json_obj
+
+    @classmethod
+    def from_json(cls, json_obj: Dict[str, Any]):
+        """
+        Also reads the dicts search results used to be, where arxiv authors
+        are a comma separated string.
+        """
+        kwargs = {k: v for k, v in json_obj.items() if k in cls.__dataclass_fields__}
+        authors = kwargs.get("authors") or []
+        if isinstance(authors, str):
+            authors = [name for name in authors.split(",") if name.strip()]
+        kwargs["authors"] = [Author.from_json(a) for a in authors]
+        return cls(**kwargs)
+
+
+@dataclass
+class PaperPage(object):
+    number: int = 0  # 1-based page number
+    start: int = 0  # offset of the page in PaperDocument.text
+    text: str = ""
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.text)
+
+
+@dataclass
+class PaperSection(object):
+    title: str = ""
+    level: int = 1
+    page: int = 0
+    start: int = 0  # offsets in PaperDocument.text
+    end: int = 0
+
+
+@dataclass
+class PaperCaption(object):
+    label: str = ""  # e.g. "Figure 3" or "Table 1"
+    caption: str = ""
+    page: int = 0
+    start: int = 0
+
+
 @dataclass
+class PaperDocument(object):
+    """
+    Page level representation of a paper, identified by the content hash of
+    its pdf. Nodes only keep the id, the document itself lives in the paper
+    store.
+    """
+    id: str = ""
+    pages: List[PaperPage] = field(default_factory=list)
+    sections: List[PaperSection] = field(default_factory=list)
+    captions: List[PaperCaption] = field(default_factory=list)
+    references: List[str] = field(default_factory=list)
+
+    @property
+    def text(self) -> str:
+        return "".join(page.text for page in self.pages)
+
+    def page_at(self, offset: int) -> PaperPage:
+        for page in self.pages:
+            if page.start <= offset < page.end:
+                return page
+        return None
+
+    def section_at(self, offset: int) -> PaperSection:
+        found = None
+        for section in self.sections:
+            if section.start <= offset < section.end:
+                found = section  # the innermost section wins
+        return found
+
+    def to_json(self):
+        json_obj = {}
+        for key in self.__dataclass_fields__.keys():
+            value = getattr(self, key)
+            if key in ("pages", "sections", "captions"):
+                value = [asdict(v) for v in value]
+            json_obj[key] = value
+        return json_obj
+
+    @classmethod
+    def from_json(cls, json_obj: Dict[str, Any]):
+        obj = cls()
+        for k, v in json_obj.items():
+            if k == "pages":
+                v = [PaperPage(**p) for p in v]
+            elif k == "sections":
+                v = [PaperSection(**s) for s in v]
+            elif k == "captions":
+                v = [PaperCaption(**c) for c in v]
+            setattr(obj, k, v)
+        return obj
+
+
+class NodeStore(object):
+    """
+    Index of the nodes of one tree by id. Every node of a tree shares its
+    store, so any node can be found in constant time from any other.
+    """
+
+    def __init__(self) -> None:
+        self._nodes: Dict[str, "Node"] = {}
+
+    def get(self, node_id: str) -> "Node":
+        return self._nodes.get(node_id)
+
+    def __contains__(self, node_id: str) -> bool:
+        return node_id in self._nodes
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def _add_subtree(self, node: "Node") -> None:
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            node._store = self
+            self._nodes[node.id] = node
+            stack.extend(node._children.values())
+
+    def _remove_subtree(self, node: "Node") -> None:
+        # the detached subtree becomes a tree of its own
+        store = NodeStore()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            self._nodes.pop(node.id, None)
+            node._store = store
+            store._nodes[node.id] = node
+            stack.extend(node._children.values())
+
+
+# eq=False: nodes are compared by identity, field-wise comparison would walk
+# the whole tree through prev and children
+@dataclass(eq=False)
 class Node(object):
     prev: "Node" = None
-    children: list["Node"] = field(default_factory=list)
     name: str = ""
     query: str = ""
     answer: str = ""
     search_result: str = ""
     related_questions: str = ""
     related_concepts: str = ""
-    article: dict = ""
-    paper_content: str = ""
+    article: Article = None
+    paper_content: str = ""  # only set on trees exported before paper_id
+    paper_id: str = ""  # id of the PaperDocument in the paper store
     paper_summary: str = ""
     current_stream: Any = None
     next_stream_is_summary: bool = False
@@ -41,18 +258,100 @@ class Node(object):
     messages: List[ChatMessage] = field(default_factory=list)
     need_upload_paper: bool = False
     chat_summary: str = ""
+    history_summary: str = ""  # running summary of messages[:summarized_count]
+    summarized_count: int = 0
+    id: str = field(default_factory=lambda: uuid4().hex)  # stable across export and import
+    # children by id in display order, and by name, with ids in display order
+    _children: Dict[str, "Node"] = field(default_factory=dict, init=False, repr=False)
+    _children_by_name: Dict[str, Dict[str, "Node"]] = field(default_factory=dict, init=False, repr=False)
+    _store: NodeStore = field(default=None, init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        NodeStore()._add_subtree(self)
+
+    def __setattr__(self, key: str, value: Any) -> None:
+        parent = self.__dict__.get("prev")
+        if key == "name" and parent is not None and self.__dict__.get("id") in parent._children:
+            # keep the parent's name index in step with renames
+            parent._unindex_name(self)
+            super().__setattr__(key, value)
+            parent._index_name(self)
+        else:
+            super().__setattr__(key, value)
+
+    def _index_name(self, child: "Node") -> None:
+        self._children_by_name.setdefault(child.name, {})[child.id] = child
+
+    def _unindex_name(self, child: "Node") -> None:
+        siblings = self._children_by_name.get(child.name)
+        if siblings is not None:
+            siblings.pop(child.id, None)
+            if not siblings:
+                del self._children_by_name[child.name]
+
+    @property
+    def children(self) -> List["Node"]:
+        return list(self._children.values())
+
+    @property
+    def store(self) -> NodeStore:
+        return self._store
+
+    @property
+    def recent_messages(self) -> List[ChatMessage]:
+        """Messages not yet folded into history_summary."""
+        return self.messages[self.summarized_count:]
+
+    def add_child(self, node: "Node") -> "Node":
+        """
+        Appends node to the children, moving it and its subtree here if it
+        has a parent already. Returns the node.
+        """
+        ancestor = self
+        while ancestor is not None:
+            if ancestor is node:
+                raise ValueError(f"cannot move node {node.id} below itself")
+            ancestor = ancestor.prev
+        if node.prev is not None:
+            node.prev.remove_child(node.id, keep_store=node.prev._store is self._store)
+        node.prev = self
+        self._children[node.id] = node
+        self._index_name(node)
+        if node._store is not self._store:
+            self._store._add_subtree(node)
+        return node
+
+    def remove_child(self, node_id: str, keep_store: bool = False) -> "Node":
+        """
+        Detaches the child with node_id and returns it, or None if there is
+        no such child. The detached subtree leaves the tree's store unless
+        keep_store is set.
+        """
+        child = self._children.pop(node_id, None)
+        if child is None:
+            return None
+        self._unindex_name(child)
+        child.prev = None
+        if not keep_store:
+            self._store._remove_subtree(child)
+        return child
+
+    def move_to(self, parent: "Node") -> "Node":
+        return parent.add_child(self)
+
+    def get_child(self, node_id: str) -> "Node":
+        return self._children.get(node_id)
 
     def get_child_by_name(self, name: str) -> "Node":
-        for child in self.children:
-            if child.name == name:
-                return child
-        return None
+        """
+        Returns the first child named name, names are not unique.
+        """
+        siblings = self._children_by_name.get(name)
+        return next(iter(siblings.values())) if siblings else None
 
     def remove_child_by_name(self, name: str) -> "Node":
-        for index, child in enumerate(self.children):
-            if child.name == name:
-                del self.children[index]
-                break
+        if child := self.get_child_by_name(name):
+            self.remove_child(child.id)
         return self
 
     @property
@@ -66,30 +365,38 @@ class Node(object):
     def to_json(self):
         json_obj = {}
         for key, _ in self.__dataclass_fields__.items():
-            if key == "prev":
+            if key.startswith("_"):
+                continue
+            elif key == "prev":
                 json_obj[key] = None
-            elif key == "children":
-                json_obj[key] = [child.to_json() for child in self.children]
             elif key == "messages":
                 json_obj[key] = [m.to_json() for m in self.messages]
+            elif key == "article":
+                json_obj[key] = self.article.to_json() if self.article else None
             else:
                 json_obj[key] = getattr(self, key)
+        json_obj["children"] = [child.to_json() for child in self._children.values()]
         return json_obj
         
     @classmethod
     def from_json(cls, json_obj: Dict[str, Any]):
-        obj = cls()
+        """
+        Trees exported before node ids get new ids.
+        """
+        obj = cls(id=json_obj.get("id") or uuid4().hex)
+        children = []
         for k, v in json_obj.items():
-            if k == "prev":
-                setattr(obj, k, None)
+            if k in ("prev", "id") or k.startswith("_"):
+                continue
             elif k == "children":
                 children = [Node.from_json(child) for child in v]
-                for c in children:
-                    c.prev = obj
-                setattr(obj, k, children)
             elif k == "messages":
                 messages = [ChatMessage.from_json(m) for m in v]
                 setattr(obj, k, messages)
+            elif k == "article":
+                setattr(obj, k, Article.from_json(v) if v else None)
             else:
                 setattr(obj, k, v)
+        for child in children:
+            obj.add_child(child)
         return obj
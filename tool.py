@@ -3,7 +3,8 @@ Utility functions to help with the tools api commonly used in LLMs.
 """
 
 import inspect
-from typing import Callable, Optional, Dict, List, Any, get_type_hints, get_origin
+import json
+from typing import Callable, Optional, Dict, List, Any, Tuple, get_type_hints, get_origin
 
 try:
     # For Python 3.9 and later
@@ -195,3 +196,121 @@ def get_tools_spec(func: Callable, name: Optional[str] = None) -> Dict[str, Any]
         )
 
     return function_info
+
+
+class ToolArgumentError(ValueError):
+    """
+    Raised when the arguments of a tool call do not match the tool's spec.
+    """
+
+    def __init__(self, tool_name: str, message: str) -> None:
+        super().__init__(f"{tool_name}: {message}")
+        self.tool_name = tool_name
+
+
+def _decode_value(tool_name: str, path: str, spec: Dict[str, Any], value: Any) -> Any:
+    type_name = spec["type"]
+    if type_name == "string":
+        if not isinstance(value, str):
+            raise ToolArgumentError(tool_name, f"{path} must be a string, got {value!r}")
+        if "enum" in spec and value not in spec["enum"]:
+            raise ToolArgumentError(tool_name, f"{path} must be one of {spec['enum']}, got {value!r}")
+        return value
+    if type_name == "boolean":
+        if isinstance(value, str) and value.lower() in ("true", "false"):
+            return value.lower() == "true"
+        if not isinstance(value, bool):
+            raise ToolArgumentError(tool_name, f"{path} must be a boolean, got {value!r}")
+        return value
+    if type_name == "integer":
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or int(value) != value:
+            raise ToolArgumentError(tool_name, f"{path} must be an integer, got {value!r}")
+        return int(value)
+    if type_name == "number":
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ToolArgumentError(tool_name, f"{path} must be a number, got {value!r}")
+        return float(value)
+    # array of objects, see _get_type_spec
+    if not isinstance(value, list):
+        raise ToolArgumentError(tool_name, f"{path} must be an array, got {value!r}")
+    properties = spec["items"]["properties"]
+    items = []
+    for i, item in enumerate(value):
+        if not isinstance(item, dict) and len(properties) == 1:
+            # models often flatten single field objects, e.g. ["q1", "q2"]
+            item = {next(iter(properties)): item}
+        items.append(_decode_object(tool_name, f"{path}[{i}]", properties, item))
+    return items
+
+
+def _decode_object(tool_name: str, path: str, properties: Dict[str, Any], value: Any) -> Dict[str, Any]:
+    if not isinstance(value, dict):
+        raise ToolArgumentError(tool_name, f"{path or 'arguments'} must be an object, got {value!r}")
+    decoded = {}
+    for name, spec in properties.items():
+        if name not in value:
+            raise ToolArgumentError(tool_name, f"missing {path + '.' if path else ''}{name}")
+        decoded[name] = _decode_value(tool_name, f"{path + '.' if path else ''}{name}", spec, value[name])
+    return decoded
+
+
+class Tool(object):
+    """
+    A function stub registered as a tool. Its spec is compiled once, so
+    every request sends the same spec, and the arguments of its calls are
+    decoded against that spec.
+    """
+
+    def __init__(self, func: Callable, name: Optional[str] = None) -> None:
+        self.func = func
+        self.spec = get_tools_spec(func, name)
+        self.name = self.spec["name"]
+        # the entry of the `tools` request parameter
+        self.tool = {"type": "function", "function": self.spec}
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def decode(self, arguments: str | Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Validates the arguments of a call, a json string or an already
+        parsed dict, and converts them to python values.
+        """
+        if isinstance(arguments, str):
+            try:
+                arguments = json.loads(arguments)
+            except ValueError as e:
+                raise ToolArgumentError(self.name, f"arguments are not valid json: {e}")
+        return _decode_object(self.name, "", self.spec["parameters"]["properties"], arguments)
+
+
+_registry: Dict[str, Tool] = {}
+
+
+def register(func: Callable = None, name: Optional[str] = None):
+    """
+    Decorator registering a function stub as a tool, usable as @register or
+    @register(name="...").
+    """
+    def wrap(func: Callable) -> Tool:
+        tool = Tool(func, name)
+        # re-registering replaces, modules may be reloaded in development
+        _registry[tool.name] = tool
+        return tool
+    return wrap(func) if func is not None else wrap
+
+
+def get_tool(name: str) -> Tool:
+    try:
+        return _registry[name]
+    except KeyError:
+        raise ToolArgumentError(name, "no such tool is registered")
+
+
+def decode(tool_call) -> Tuple[Tool, Dict[str, Any]]:
+    """
+    Returns the registered tool of a `tool_calls[...]` entry and its decoded
+    arguments.
+    """
+    tool = get_tool(tool_call.function.name)
+    return tool, tool.decode(tool_call.function.arguments)